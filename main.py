@@ -1,13 +1,36 @@
+import asyncio
 import sqlite3
-import requests
+import threading
+import httpx
 import io
+import itertools
+import json
 import numpy as np
 import time, math
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import wraps
+from urllib.parse import parse_qs, urlsplit
+from xml.etree import ElementTree
+import multiprocessing
+import os
+import sys
 import matplotlib
 
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
 
 from telegram import (
     Update,
@@ -23,8 +46,10 @@ from telegram.ext import (
     ContextTypes,
     MessageHandler,
     filters,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    TypeHandler
 )
+from telegram.error import RetryAfter, TelegramError
 
 # Словари валют
 fiat_info = {
@@ -52,38 +77,429 @@ crypto_info = {
 # Gate.io: https://api.gateio.ws/api/v4/spot/tickers?currency_pair=BTC_USDT
 # ByBit: https://api.bybit.com/spot/v1/ticker/24hr?symbol=BTCUSDT
 
-# Глобальные переменные
-bot_messages = {}  # {chat_id: [message_id, ...]}
-session = requests.Session()
+# Метрики в формате Prometheus: гистограммы задержек обработчиков, запросов к внешним API
+# и отрисовки графиков, счётчики ошибок и попаданий в кэши. Собираются всегда,
+# при METRICS_ENABLED отдаются по HTTP на METRICS_LISTEN:METRICS_PORT/metrics
+METRICS_ENABLED = False
+METRICS_LISTEN = '127.0.0.1'
+METRICS_PORT = 9108
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+_metric_counters = {}  # {(name, labels): value}
+_metric_histograms = {}  # {(name, labels): [число наблюдений по корзинам, сумма, количество]}
+_metrics_server = None
+
+
+def metric_inc(name: str, value: float = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    _metric_counters[key] = _metric_counters.get(key, 0) + value
+
+
+def metric_observe(name: str, value: float, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    hist = _metric_histograms.get(key)
+    if hist is None:
+        hist = _metric_histograms[key] = [[0] * len(METRICS_BUCKETS), 0.0, 0]
+    i = bisect_left(METRICS_BUCKETS, value)
+    if i < len(METRICS_BUCKETS):
+        hist[0][i] += 1
+    hist[1] += value
+    hist[2] += 1
+
+
+# Обёртка для обработчиков Telegram: время выполнения и необработанные исключения
+def instrument_handler(callback):
+    @wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metric_inc("bot_handler_errors_total", handler=callback.__name__)
+            raise
+        finally:
+            metric_observe("bot_handler_duration_seconds", time.perf_counter() - started, handler=callback.__name__)
+    return wrapper
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def _render_samples(lines: list, kind: str, samples: dict):
+    family = None
+    for (name, labels), value in sorted(samples.items()):
+        if name != family:
+            lines.append(f"# TYPE {name} {kind}")
+            family = name
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+
+def render_metrics() -> str:
+    counters = dict(_metric_counters)
+    counters[("cache_requests_total", (("cache", "settings"), ("result", "hit")))] = settings_cache_stats["hits"]
+    counters[("cache_requests_total", (("cache", "settings"), ("result", "miss")))] = settings_cache_stats["misses"]
+    gauges = {("chart_cache_bytes", ()): _chart_cache_bytes, ("chart_render_pending", ()): _chart_pending,
+              ("price_cache_entries", ()): len(_price_cache)}
+    if _cached_cbr_data is not None:
+        gauges[("cbr_data_age_seconds", ())] = round(get_cbr_age(), 3)
+    for host, status in rate_limit_status().items():
+        labels = (("host", host),)
+        counters[("rate_limit_waited_total", labels)] = status["waited"]
+        counters[("rate_limit_shed_total", labels)] = status["shed"]
+        gauges[("rate_limit_saturation", labels)] = round(status["saturation"], 4)
+        gauges[("rate_limit_blocked_seconds", labels)] = round(status["blocked_for"], 3)
+
+    lines = []
+    _render_samples(lines, "counter", counters)
+    _render_samples(lines, "gauge", gauges)
+    family = None
+    for (name, labels), (buckets, total, count) in sorted(_metric_histograms.items()):
+        if name != family:
+            lines.append(f"# TYPE {name} histogram")
+            family = name
+        cumulative = 0
+        for bound, n in zip(METRICS_BUCKETS, buckets):
+            cumulative += n
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while await asyncio.wait_for(reader.readline(), 5) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render_metrics().encode()
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server():
+    global _metrics_server
+    if METRICS_ENABLED and _metrics_server is None:
+        _metrics_server = await asyncio.start_server(handle_metrics_request, METRICS_LISTEN, METRICS_PORT)
+
+
+async def stop_metrics_server():
+    global _metrics_server
+    if _metrics_server is not None:
+        _metrics_server.close()
+        await _metrics_server.wait_closed()
+        _metrics_server = None
+
+
+# Асинхронный HTTP-клиент: общий пул соединений и ограничение параллельных запросов на хост
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE = 20
+HTTP_PER_HOST_LIMIT = 10
+_http_client = None
+_host_semaphores = {}  # {host: asyncio.Semaphore}
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+            timeout=httpx.Timeout(5.0, connect=3.0)
+        )
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+# Ограничение частоты запросов к биржам: token bucket на хост с учётом веса эндпоинтов.
+# Бюджет сверяется с заголовками ответов о фактически израсходованном лимите; если ждать
+# бюджета дольше RATE_LIMIT_MAX_WAIT, запрос отклоняется, не доводя до бана по IP
+RATE_LIMITS = {  # {host: (вес, окно в секундах)}
+    "api.binance.com": (6000, 60),
+    "api.gateio.ws": (200, 10),
+    "api.bybit.com": (600, 5),
+}
+RATE_LIMIT_SAFETY = 0.9  # используем не больше этой доли официального лимита
+RATE_LIMIT_MAX_WAIT = 2.0  # дольше ждать бюджет не будем — запрос отклоняется, сек
+BINANCE_WEIGHTS = {"/api/v3/ticker/price": (2, 4), "/api/v3/klines": (2, 2), "/api/v3/exchangeInfo": (20, 20)}
+_rate_buckets = {}  # {host: {"tokens", "updated", "blocked_until", "waited", "shed"}}
+
+
+def endpoint_weight(host: str, path: str, url: str, params) -> int:
+    if host == "api.binance.com" and path in BINANCE_WEIGHTS:
+        with_symbol, without_symbol = BINANCE_WEIGHTS[path]
+        return with_symbol if "symbol=" in url or (params and "symbol" in params) else without_symbol
+    return 1
+
+
+def _rate_bucket(host: str):
+    capacity = RATE_LIMITS[host][0] * RATE_LIMIT_SAFETY
+    bucket = _rate_buckets.setdefault(host, {"tokens": capacity, "updated": time.monotonic(),
+                                             "blocked_until": 0.0, "waited": 0, "shed": 0})
+    now = time.monotonic()
+    rate = capacity / RATE_LIMITS[host][1]
+    bucket["tokens"] = min(capacity, bucket["tokens"] + (now - bucket["updated"]) * rate)
+    bucket["updated"] = now
+    return bucket, capacity, rate
+
+
+async def acquire_rate_budget(host: str, weight: int):
+    if host not in RATE_LIMITS:
+        return
+    waited = False
+    while True:
+        bucket, capacity, rate = _rate_bucket(host)
+        now = time.monotonic()
+        if bucket["blocked_until"] > now:
+            wait = bucket["blocked_until"] - now
+        elif bucket["tokens"] >= weight:
+            bucket["tokens"] -= weight
+            return
+        else:
+            wait = (weight - bucket["tokens"]) / rate
+        if wait > RATE_LIMIT_MAX_WAIT:
+            bucket["shed"] += 1
+            raise Exception(f"Превышен лимит запросов к {host}, попробуйте позже")
+        if not waited:
+            bucket["waited"] += 1
+            waited = True
+        await asyncio.sleep(wait)
+
+
+def update_rate_budget(host: str, resp: httpx.Response):
+    if host not in RATE_LIMITS:
+        return
+    bucket, capacity, _ = _rate_bucket(host)
+    headers = resp.headers
+    remaining = None
+    if "X-MBX-USED-WEIGHT-1M" in headers:
+        remaining = capacity - int(headers["X-MBX-USED-WEIGHT-1M"])
+    elif "X-Gate-RateLimit-Requests-Remain" in headers:
+        remaining = int(headers["X-Gate-RateLimit-Requests-Remain"])
+    elif "X-Bapi-Limit-Status" in headers:
+        remaining = int(headers["X-Bapi-Limit-Status"])
+    if remaining is not None:
+        bucket["tokens"] = max(0.0, min(bucket["tokens"], remaining))
+    if resp.status_code in (418, 429):
+        retry_after = float(headers.get("Retry-After", RATE_LIMITS[host][1]))
+        bucket["blocked_until"] = time.monotonic() + retry_after
+        bucket["tokens"] = 0.0
+        print(f"Биржа {host} ограничила запросы (HTTP {resp.status_code}) на {retry_after:.0f} сек")
+
+
+# Загрузка лимитов: доля израсходованного бюджета, число ожиданий и отклонённых запросов
+def rate_limit_status() -> dict:
+    status = {}
+    for host in RATE_LIMITS:
+        bucket, capacity, _ = _rate_bucket(host)
+        status[host] = {"saturation": 1 - bucket["tokens"] / capacity, "waited": bucket["waited"],
+                        "shed": bucket["shed"], "blocked_for": max(0.0, bucket["blocked_until"] - time.monotonic())}
+    return status
+
+
+async def http_get(url: str, params=None, timeout: float = 3) -> httpx.Response:
+    parts = urlsplit(url)
+    host = parts.hostname
+    await acquire_rate_budget(host, endpoint_weight(host, parts.path, url, params))
+    semaphore = _host_semaphores.setdefault(host, asyncio.Semaphore(HTTP_PER_HOST_LIMIT))
+    async with semaphore:
+        started = time.perf_counter()
+        try:
+            resp = await get_http_client().get(url, params=params, timeout=timeout)
+        except httpx.HTTPError as e:
+            metric_inc("upstream_errors_total", host=host, error=type(e).__name__)
+            raise
+        finally:
+            metric_observe("upstream_request_duration_seconds", time.perf_counter() - started, host=host)
+    metric_inc("upstream_requests_total", host=host, status=str(resp.status_code))
+    update_rate_budget(host, resp)
+    return resp
+
 
-# Кэш для данных Центробанка (60 сек)
+async def http_get_json(url: str, params=None, timeout: float = 3):
+    return (await http_get(url, params=params, timeout=timeout)).json()
+
+
+async def http_get_text(url: str, params=None, timeout: float = 3) -> str:
+    resp = await http_get(url, params=params, timeout=timeout)
+    resp.raise_for_status()
+    return resp.text
+
+
+# Кэш для данных Центробанка (обновляется в фоне, устаревает через CBR_CACHE_TTL сек)
 _cached_cbr_data = None
 _cached_cbr_timestamp = 0
+# Матрица кросс-курсов по всем валютам ЦБ (и рублю), пересчитывается при каждом обновлении
+# данных ЦБ: _cbr_matrix[i, j] — сколько единиц валюты j стоит 1 единица валюты i
+_cbr_index = {}  # {code: индекс строки/столбца}
+_cbr_matrix = np.ones((1, 1))
 
 
-def get_cbr_data():
+def build_cbr_cross_rates(data):
+    global _cbr_index, _cbr_matrix
+    codes = ["RUB"] + [code for code in data['Valute'] if code != "RUB"]
+    rub_rates = np.array([1.0] + [data['Valute'][code]['Value'] / data['Valute'][code]['Nominal']
+                                  for code in codes[1:]])
+    _cbr_matrix = rub_rates[:, None] / rub_rates[None, :]
+    _cbr_index = {code: i for i, code in enumerate(codes)}
+
+
+def set_cbr_data(data, timestamp: float):
     global _cached_cbr_data, _cached_cbr_timestamp
-    now = time.time()
-    if _cached_cbr_data is None or now - _cached_cbr_timestamp > 60:
-        _cached_cbr_data = session.get(CBR_API_URL, timeout=3).json()
-        _cached_cbr_timestamp = now
+    build_cbr_cross_rates(data)
+    _cached_cbr_data = data
+    _cached_cbr_timestamp = timestamp
+
+
+# Последний удачный снимок ЦБ сохраняется на диск, чтобы после перезапуска
+# сразу отвечать из него, пока идёт обновление
+def save_cbr_cache(data, timestamp: float):
+    tmp_path = CBR_CACHE_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"timestamp": timestamp, "data": data}, f, ensure_ascii=False)
+    os.replace(tmp_path, CBR_CACHE_FILE)
+
+
+def load_cbr_cache():
+    try:
+        with open(CBR_CACHE_FILE, encoding="utf-8") as f:
+            cached = json.load(f)
+        set_cbr_data(cached["data"], cached["timestamp"])
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Не удалось прочитать кэш ЦБ: {e}")
+
+
+_cbr_refresh_task = None
+
+
+async def refresh_cbr_data(context: ContextTypes.DEFAULT_TYPE = None):
+    shared = await state_backend.get("cbr")
+    if shared is not None and shared["timestamp"] > _cached_cbr_timestamp:
+        set_cbr_data(shared["data"], shared["timestamp"])  # данные уже обновил другой экземпляр
+    if _cached_cbr_data is not None and (get_cbr_age() < CBR_REFRESH_INTERVAL / 2 or
+                                         not await state_backend.acquire_lock("cbr", CBR_REFRESH_INTERVAL / 2)):
+        return
+    try:
+        data = await http_get_json(CBR_API_URL, timeout=3)
+        now = time.time()
+        set_cbr_data(data, now)
+    except Exception as e:
+        print(f"Не удалось обновить данные ЦБ: {e}")
+        if _cached_cbr_data is None:
+            raise
+        return
+    await state_backend.set("cbr", {"timestamp": now, "data": data})
+    try:
+        await asyncio.to_thread(save_cbr_cache, data, now)
+    except Exception as e:
+        print(f"Не удалось сохранить кэш ЦБ: {e}")
+
+
+def _cbr_refresh_done(task: asyncio.Task):
+    global _cbr_refresh_task
+    _cbr_refresh_task = None
+    if not task.cancelled():
+        task.exception()
+
+
+# Stale-while-revalidate: устаревший снимок отдаётся сразу, а обновление идёт в фоне.
+# Ждать запроса к ЦБ приходится только когда снимка ещё нет совсем
+async def get_cbr_data():
+    global _cbr_refresh_task
+    if _cached_cbr_data is not None and get_cbr_age() <= CBR_CACHE_TTL:
+        metric_inc("cache_requests_total", cache="cbr", result="hit")
+        return _cached_cbr_data
+    metric_inc("cache_requests_total", cache="cbr", result="miss" if _cached_cbr_data is None else "stale")
+    if _cbr_refresh_task is None:
+        _cbr_refresh_task = asyncio.create_task(refresh_cbr_data())
+        _cbr_refresh_task.add_done_callback(_cbr_refresh_done)
+    if _cached_cbr_data is None:
+        await asyncio.shield(_cbr_refresh_task)
     return _cached_cbr_data
 
 
+def get_cbr_age() -> float:
+    return time.time() - _cached_cbr_timestamp
+
+
+def cbr_staleness_note() -> str:
+    if _cached_cbr_data is None or get_cbr_age() <= CBR_STALE_AFTER:
+        return ""
+    return f"\n⚠️ Курсы ЦБ обновлены {int(get_cbr_age() // 60)} мин. назад"
+
+
+# Соединения с БД: по одному долгоживущему соединению на поток (WAL, настроенные PRAGMA,
+# кэш подготовленных выражений). Запись идёт через единственный поток-писатель,
+# чтение — через небольшой пул; event loop никогда не ждёт SQLite напрямую
+DB_PATH = 'subscriptions.db'
+DB_READ_THREADS = 4
+DB_STATEMENT_CACHE = 256
+_db_local = threading.local()
+_db_connections = []
+_db_connections_lock = threading.Lock()
+_db_write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+_db_read_executor = ThreadPoolExecutor(max_workers=DB_READ_THREADS, thread_name_prefix="db-reader")
+
+
+def get_db_connection() -> sqlite3.Connection:
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, cached_statements=DB_STATEMENT_CACHE, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-8000")
+        conn.execute("PRAGMA busy_timeout=5000")
+        _db_local.conn = conn
+        with _db_connections_lock:
+            _db_connections.append(conn)
+    return conn
+
+
+def close_db():
+    _db_write_executor.shutdown(wait=True)
+    _db_read_executor.shutdown(wait=True)
+    with _db_connections_lock:
+        for conn in _db_connections:
+            conn.close()
+        _db_connections.clear()
+
+
 # Функция для проверки и добавления столбца в таблицу
 def ensure_column_exists(table: str, column: str, definition: str):
-    with sqlite3.connect('subscriptions.db') as conn:
-        cursor = conn.cursor()
-        cursor.execute(f"PRAGMA table_info({table})")
-        cols = [info[1] for info in cursor.fetchall()]
-        if column not in cols:
-            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
-            conn.commit()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"PRAGMA table_info({table})")
+    cols = [info[1] for info in cursor.fetchall()]
+    if column not in cols:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        conn.commit()
 
 
-# Инициализация БД
-def init_db():
-    with sqlite3.connect('subscriptions.db') as conn:
+# Инициализация БД (выполняется в потоке-писателе)
+def _init_db():
+    conn = get_db_connection()
+    with conn:
         conn.execute('''
             CREATE TABLE IF NOT EXISTS subscriptions (
                 user_id INTEGER,
@@ -99,37 +515,126 @@ def init_db():
                 default_currency TEXT DEFAULT 'USD'
             )
         ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS candles (
+                symbol TEXT,
+                interval TEXT,
+                open_time INTEGER,
+                open REAL,
+                high REAL,
+                low REAL,
+                close REAL,
+                volume REAL,
+                PRIMARY KEY (symbol, interval, open_time)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS candle_sync (
+                symbol TEXT,
+                interval TEXT,
+                synced_from INTEGER,
+                PRIMARY KEY (symbol, interval)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS fiat_rates (
+                date TEXT,
+                code TEXT,
+                rate REAL,
+                PRIMARY KEY (date, code)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS tracked_messages (
+                chat_id INTEGER,
+                message_id INTEGER,
+                PRIMARY KEY (chat_id, message_id)
+            ) WITHOUT ROWID
+        ''')
     ensure_column_exists("user_settings", "data_source", "TEXT DEFAULT 'BINANCE'")
 
 
-init_db()
+def init_db():
+    _db_write_executor.submit(_init_db).result()
 
 
 # Работа с БД
-def db_execute(query, params=()):
-    with sqlite3.connect('subscriptions.db') as conn:
+def _db_execute_sync(query, params):
+    conn = get_db_connection()
+    with conn:
         conn.execute(query, params)
-        conn.commit()
 
 
-def db_fetchall(query, params=()):
-    with sqlite3.connect('subscriptions.db') as conn:
-        return conn.execute(query, params).fetchall()
+def _db_fetchall_sync(query, params):
+    return get_db_connection().execute(query, params).fetchall()
+
+
+def _db_executemany_sync(query, seq_of_params):
+    conn = get_db_connection()
+    with conn:
+        conn.executemany(query, seq_of_params)
+
+
+async def db_execute(query, params=()):
+    await asyncio.get_running_loop().run_in_executor(_db_write_executor, _db_execute_sync, query, params)
+
 
+async def db_executemany(query, seq_of_params):
+    await asyncio.get_running_loop().run_in_executor(_db_write_executor, _db_executemany_sync, query,
+                                                     seq_of_params)
 
-# Функции настроек
-def load_user_settings(user_id):
-    settings = db_fetchall('SELECT notifications, default_currency, data_source FROM user_settings WHERE user_id = ?',
-                           (user_id,))
-    return {
-        "notifications": bool(settings[0][0]),
-        "default_currency": settings[0][1],
-        "data_source": settings[0][2]
-    } if settings else {"notifications": True, "default_currency": "USD", "data_source": "BINANCE"}
 
+async def db_fetchall(query, params=()):
+    return await asyncio.get_running_loop().run_in_executor(_db_read_executor, _db_fetchall_sync, query, params)
 
-def save_user_settings(user_id, settings):
-    db_execute('''
+
+# Функции настроек.
+# Кэш настроек {user_id: settings} с LRU-вытеснением; save_user_settings пишет сквозь кэш
+SETTINGS_CACHE_SIZE = 10000
+_settings_cache = OrderedDict()
+settings_cache_stats = {"hits": 0, "misses": 0}
+
+
+def _cache_user_settings(user_id, settings):
+    _settings_cache[user_id] = settings
+    _settings_cache.move_to_end(user_id)
+    while len(_settings_cache) > SETTINGS_CACHE_SIZE:
+        _settings_cache.popitem(last=False)
+
+
+async def load_user_settings(user_id):
+    # при общем хранилище настройки может изменить другой экземпляр, поэтому кэш — там
+    cached = await state_backend.get(f"settings:{user_id}") if state_backend.shared else _settings_cache.get(user_id)
+    if cached is not None:
+        settings_cache_stats["hits"] += 1
+        if not state_backend.shared:
+            _settings_cache.move_to_end(user_id)
+        return dict(cached)
+    settings_cache_stats["misses"] += 1
+    rows = await db_fetchall(
+        'SELECT notifications, default_currency, data_source FROM user_settings WHERE user_id = ?', (user_id,))
+    settings = {
+        "notifications": bool(rows[0][0]),
+        "default_currency": rows[0][1],
+        "data_source": rows[0][2]
+    } if rows else {"notifications": True, "default_currency": "USD", "data_source": "BINANCE"}
+    if state_backend.shared:
+        # Запись в общем хранилище главнее локальной БД: если её создали, пока шёл запрос, берём её
+        if not await state_backend.set(f"settings:{user_id}", settings, nx=True):
+            settings = await state_backend.get(f"settings:{user_id}") or settings
+        return dict(settings)
+    if user_id in _settings_cache:  # настройки сохранили, пока шёл запрос к БД
+        return dict(_settings_cache[user_id])
+    _cache_user_settings(user_id, settings)
+    return dict(settings)
+
+
+async def save_user_settings(user_id, settings):
+    if state_backend.shared:
+        await state_backend.set(f"settings:{user_id}", dict(settings))
+    else:
+        _cache_user_settings(user_id, dict(settings))
+    await db_execute('''
         INSERT OR REPLACE INTO user_settings (user_id, notifications, default_currency, data_source)
         VALUES (?, ?, ?, ?)
     ''', (user_id, settings['notifications'], settings['default_currency'], settings['data_source']))
@@ -139,6 +644,53 @@ def save_user_settings(user_id, settings):
 BOT_TOKEN = 'YOUR_BOT_TOCKEN'
 BINANCE_API_URL = 'https://api.binance.com/api/v3/ticker/price'
 CBR_API_URL = 'https://www.cbr-xml-daily.ru/daily_json.js'
+CBR_CACHE_TTL = 60  # после этого возраста снимок ЦБ обновляется в фоне, сек
+CBR_REFRESH_INTERVAL = 45  # фоновое обновление заранее, до истечения TTL, сек
+CBR_STALE_AFTER = 300  # с этого возраста в ответах показывается предупреждение, сек
+CBR_CACHE_FILE = 'cbr_cache.json'
+CRYPTO_SOURCES = ["BINANCE", "GATEIO", "BYBIT"]
+COMPARE_DEADLINE = 3.5  # общий дедлайн /compare для всех источников, сек
+PRICE_CACHE_TTL = 5  # время жизни цены в кэше, сек
+PRICE_CACHE_MAX_SIZE = 1000  # максимум пар (источник, код) в кэше цен
+INTERVAL_SECONDS = {"1m": 60, "1h": 3600, "1d": 86400, "1w": 7 * 86400}  # длительность свечей Binance
+INTERVAL_OFFSETS = {"1w": 4 * 86400}  # недельные свечи открываются в понедельник, а не в четверг (эпоха Unix)
+KLINE_COARSER = {"1m": ("1h", 60), "1h": ("1d", 24), "1d": ("1w", 7)}
+KLINE_DATE_FORMATS = {"1m": '%H:%M', "1h": '%H:%M', "1d": '%d-%m', "1w": '%m-%Y'}
+TREND_MAX_CANDLES = 3000  # больше точек на графике не нужно — интервал укрупняется
+TREND_MAX_PERIOD_DAYS = 20 * 365  # самый длинный период /trend
+TREND_UNIT_DAYS = {"minutes": 1 / 1440, "hours": 1 / 24, "days": 1, "months": 30, "years": 365}
+TREND_MAX_POINTS = 500  # точек на графике после прореживания
+TREND_DOWNSAMPLE_METHOD = "minmax"  # "minmax" (сохраняет экстремумы) или "lttb"
+TREND_MARKERS_MAX_POINTS = 100  # маркеры точек рисуются только на коротких рядах
+TICKER_SNAPSHOT_INTERVAL = 10  # период обновления снимков всех пар, сек
+TICKER_SNAPSHOT_MAX_AGE = 30  # снимок старше этого возраста не используется, сек
+SYMBOL_CATALOG_TTL = 3600  # период обновления списков активов бирж, сек
+SOURCE_STATS_WINDOW = 200  # последних запросов в статистике каждой биржи
+HEDGE_PERCENTILE = 90  # страхующий запрос, если биржа медленнее этого перцентиля своих задержек
+HEDGE_DEFAULT_DELAY = 0.5  # задержка страховки, пока статистики мало, сек
+HEDGE_MIN_DELAY = 0.15
+HEDGE_MAX_DELAY = 1.5
+STREAMING_ENABLED = False  # потоковые цены через WebSocket (нужен пакет websockets)
+STREAM_URLS = {
+    "BINANCE": "wss://stream.binance.com:9443/ws",
+    "GATEIO": "wss://api.gateio.ws/ws/v4/",
+    "BYBIT": "wss://stream.bybit.com/v5/public/spot",
+}
+STREAM_MAX_AGE = 10  # цена из потока старше этого возраста не используется, сек
+STREAM_SYMBOL_IDLE = 600  # отписка от кода, который не запрашивали столько секунд
+STREAM_RECONNECT_DELAY = 5  # пауза перед переподключением потока, сек
+ALERT_CHECK_INTERVAL = 30  # период проверки порогов подписок, сек
+ALERT_PRICE_SOURCE = "BINANCE"  # источник цен для уведомлений
+ALERT_BATCH_SIZE = 25  # уведомлений за одну пачку (лимит Telegram ~30 сообщений/сек)
+ALERT_BATCH_INTERVAL = 1.0  # пауза между пачками уведомлений, сек
+WEBHOOK_ENABLED = False  # webhook вместо long polling (нужен python-telegram-bot[webhooks])
+WEBHOOK_LISTEN = '127.0.0.1'  # TLS завершается на обратном прокси, который проксирует сюда
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = 'telegram'
+WEBHOOK_URL = 'https://example.com/telegram'  # публичный адрес прокси, регистрируется в Telegram
+WEBHOOK_SECRET_TOKEN = ''  # сверяется с заголовком X-Telegram-Bot-Api-Secret-Token
+RECORD_UPDATES_FILE = None  # путь для записи входящих апдейтов (для python main.py replay)
+LOCAL_BOT_API_URL = None  # 'http://127.0.0.1:8081/bot' — заглушка Bot API из python main.py replay
 
 KEYBOARD = [
     ['🔄 Конвертер'],
@@ -148,6 +700,187 @@ KEYBOARD = [
 ]
 
 
+# Хранилище общего состояния. По умолчанию всё живёт в процессе (LocalStateBackend);
+# с STATE_BACKEND_URL несколько экземпляров бота (например, за одним webhook) делят через
+# Redis снимки цен, данные ЦБ, кэш цен и настроек и списки сообщений для /clear.
+# Снимки обновляет экземпляр, первым взявший блокировку, остальные читают готовое
+STATE_BACKEND_URL = None  # например 'redis://localhost:6379/0' (нужен пакет redis)
+STATE_KEY_PREFIX = 'fintgbot:'
+
+
+class LocalStateBackend:
+    shared = False
+
+    def __init__(self):
+        self._values = {}  # {key: (value, момент истечения или None)}
+
+    async def get(self, key):
+        item = self._values.get(key)
+        if item is None or (item[1] is not None and item[1] < time.monotonic()):
+            return None
+        return item[0]
+
+    async def set(self, key, value, ttl=None, nx=False) -> bool:
+        if nx and await self.get(key) is not None:
+            return False
+        self._values[key] = (value, time.monotonic() + ttl if ttl else None)
+        return True
+
+    async def acquire_lock(self, name, ttl) -> bool:
+        return True  # в одном процессе за обновление и так отвечает одна задача
+
+    async def add_messages(self, batch):
+        await asyncio.get_running_loop().run_in_executor(_db_write_executor, _flush_tracked_messages_sync, batch)
+
+    async def get_messages(self, chat_id, limit) -> list:
+        rows = await db_fetchall('''
+            SELECT message_id FROM tracked_messages WHERE chat_id = ? ORDER BY message_id DESC LIMIT ?
+        ''', (chat_id, limit))
+        return [row[0] for row in rows]
+
+    async def delete_messages(self, chat_id):
+        await db_execute('DELETE FROM tracked_messages WHERE chat_id = ?', (chat_id,))
+
+    async def close(self):
+        pass
+
+
+class RedisStateBackend:
+    shared = True
+
+    def __init__(self, client, prefix: str = STATE_KEY_PREFIX):
+        self.client = client  # redis.asyncio.Redis или совместимый (например, fakeredis для проверки)
+        self.prefix = prefix
+
+    async def get(self, key):
+        raw = await self.client.get(self.prefix + key)
+        return None if raw is None else json.loads(raw)
+
+    async def set(self, key, value, ttl=None, nx=False) -> bool:
+        return bool(await self.client.set(self.prefix + key, json.dumps(value), px=int(ttl * 1000) if ttl else None,
+                                          nx=nx))
+
+    async def acquire_lock(self, name, ttl) -> bool:
+        return bool(await self.client.set(self.prefix + "lock:" + name, 1, nx=True, px=int(ttl * 1000)))
+
+    async def add_messages(self, batch):
+        by_chat = {}
+        for chat_id, message_id in batch:
+            by_chat.setdefault(chat_id, []).append(message_id)
+        pipe = self.client.pipeline(transaction=False)
+        for chat_id, message_ids in by_chat.items():
+            key = f"{self.prefix}messages:{chat_id}"
+            pipe.rpush(key, *message_ids)
+            pipe.ltrim(key, -MESSAGE_TRACK_PER_CHAT, -1)
+            pipe.expire(key, 48 * 3600)  # старше 48 ч Telegram удалять не даёт
+        await pipe.execute()
+
+    async def get_messages(self, chat_id, limit) -> list:
+        return [int(message_id) for message_id in
+                await self.client.lrange(f"{self.prefix}messages:{chat_id}", -limit, -1)]
+
+    async def delete_messages(self, chat_id):
+        await self.client.delete(f"{self.prefix}messages:{chat_id}")
+
+    async def close(self):
+        close = getattr(self.client, "aclose", None) or self.client.close
+        await close()
+
+
+state_backend = LocalStateBackend()
+
+
+def init_state_backend():
+    global state_backend
+    if STATE_BACKEND_URL:
+        if redis is None:
+            raise Exception("Для STATE_BACKEND_URL нужен пакет redis")
+        state_backend = RedisStateBackend(redis.from_url(STATE_BACKEND_URL))
+
+
+# Учёт отправленных ботом сообщений для /clear. Источник истины — таблица tracked_messages
+# (или общее хранилище), в памяти — LRU-кэш полных списков по чатам (array('q'), не больше
+# MESSAGE_TRACK_PER_CHAT последних id на чат). Новые id копятся в _pending_messages и пишутся пачками
+MESSAGE_TRACK_PER_CHAT = 300  # старше 48 ч Telegram всё равно не даёт удалять сообщения
+MESSAGE_TRACK_MAX_CHATS = 5000
+MESSAGE_FLUSH_INTERVAL = 5  # период записи новых id в БД, сек
+MESSAGE_FLUSH_BATCH = 500  # столько ожидающих id записываются сразу, не дожидаясь периодической задачи
+_tracked_messages = OrderedDict()  # {chat_id: array('q')}
+_pending_messages = []  # [(chat_id, message_id), ...]
+_tracked_flush_lock = None
+_tracked_flush_task = None
+
+
+def _tracked_flush_done(task: asyncio.Task):
+    global _tracked_flush_task
+    _tracked_flush_task = None
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Не удалось сохранить отправленные сообщения: {task.exception()}")
+
+
+def track_message(chat_id: int, message_id: int):
+    global _tracked_flush_task
+    _pending_messages.append((chat_id, message_id))
+    # Периодической задачи может не быть (нет JobQueue), поэтому большой хвост пишем сразу
+    if len(_pending_messages) >= MESSAGE_FLUSH_BATCH and _tracked_flush_task is None:
+        _tracked_flush_task = asyncio.create_task(flush_tracked_messages())
+        _tracked_flush_task.add_done_callback(_tracked_flush_done)
+    buf = _tracked_messages.get(chat_id)
+    if buf is not None:  # чаты не из кэша подгружаются из БД при первом /clear
+        buf.append(message_id)
+        if len(buf) > MESSAGE_TRACK_PER_CHAT:
+            del buf[:len(buf) - MESSAGE_TRACK_PER_CHAT]
+        _tracked_messages.move_to_end(chat_id)
+
+
+def _flush_tracked_messages_sync(batch):
+    conn = get_db_connection()
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO tracked_messages (chat_id, message_id) VALUES (?, ?)', batch)
+        # id сообщений в чате растут, поэтому оставляем MESSAGE_TRACK_PER_CHAT наибольших
+        conn.executemany('''
+            DELETE FROM tracked_messages WHERE chat_id = ? AND message_id <= (
+                SELECT message_id FROM tracked_messages WHERE chat_id = ?
+                ORDER BY message_id DESC LIMIT 1 OFFSET ?)
+        ''', [(chat_id, chat_id, MESSAGE_TRACK_PER_CHAT) for chat_id in {chat_id for chat_id, _ in batch}])
+
+
+async def flush_tracked_messages(context: ContextTypes.DEFAULT_TYPE = None):
+    global _pending_messages, _tracked_flush_lock
+    if _tracked_flush_lock is None:
+        _tracked_flush_lock = asyncio.Lock()
+    async with _tracked_flush_lock:
+        batch, _pending_messages = _pending_messages, []
+        if batch:
+            await state_backend.add_messages(batch)
+
+
+async def get_tracked_messages(chat_id: int) -> list:
+    buf = _tracked_messages.get(chat_id)
+    if buf is None:
+        await flush_tracked_messages()
+        ids = set(await state_backend.get_messages(chat_id, MESSAGE_TRACK_PER_CHAT))
+        ids.update(message_id for cid, message_id in _pending_messages if cid == chat_id)
+        ids = sorted(ids)[-MESSAGE_TRACK_PER_CHAT:]
+        if state_backend.shared:  # список дополняют и другие экземпляры — в памяти не держим
+            return ids
+        buf = _tracked_messages.get(chat_id)
+        if buf is None:
+            buf = array('q', ids)
+            _tracked_messages[chat_id] = buf
+            while len(_tracked_messages) > MESSAGE_TRACK_MAX_CHATS:
+                _tracked_messages.popitem(last=False)
+    _tracked_messages.move_to_end(chat_id)
+    return list(buf)
+
+
+async def forget_tracked_messages(chat_id: int):
+    global _pending_messages
+    _tracked_messages.pop(chat_id, None)
+    _pending_messages = [item for item in _pending_messages if item[0] != chat_id]
+    await state_backend.delete_messages(chat_id)
+
+
 # Хелперы для ответа
 def get_reply_target(update: Update):
     return update.message or (update.callback_query.message if update.callback_query else None)
@@ -157,34 +890,131 @@ async def tracked_reply(update: Update, text: str, **kwargs):
     target = get_reply_target(update)
     if target:
         msg = await target.reply_text(text, **kwargs)
-        bot_messages.setdefault(target.chat.id, []).append(msg.message_id)
+        track_message(target.chat.id, msg.message_id)
+        if text.startswith("❌"):
+            metric_inc("bot_error_replies_total")
         return msg
     print("No target for reply")
 
 
+# Локальная история курсов ЦБ: fiat_rates(date, code, rate), rate — рублей за 1 единицу
+# валюты (Value / Nominal). История загружается один раз из архива ЦБ (XML_dynamic,
+# один запрос на валюту за весь период) и затем дописывается фоновой задачей
+CBR_DYNAMIC_URL = 'https://www.cbr.ru/scripts/XML_dynamic.asp'
+FIAT_HISTORY_DAYS = 5 * 365  # глубина хранимой истории
+FIAT_HISTORY_SYNC_INTERVAL = 6 * 3600  # период дозагрузки новых курсов, сек
+_fiat_history_lock = None
+
+
+async def fetch_cbr_dynamic(cbr_id: str, start, end) -> list:
+    text = await http_get_text(CBR_DYNAMIC_URL, params={"date_req1": start.strftime('%d/%m/%Y'),
+                                                        "date_req2": end.strftime('%d/%m/%Y'),
+                                                        "VAL_NM_RQ": cbr_id}, timeout=10)
+    rows = []
+    for record in ElementTree.fromstring(text).iter("Record"):
+        day = datetime.strptime(record.get("Date"), '%d.%m.%Y').strftime('%Y-%m-%d')
+        value = float(record.findtext("Value").replace(",", "."))
+        rows.append((day, value / int(record.findtext("Nominal"))))
+    return rows
+
+
+async def sync_fiat_history(context: ContextTypes.DEFAULT_TYPE = None, codes=None):
+    global _fiat_history_lock
+    # Плановую дозагрузку выполняет один экземпляр; загрузка по требованию (codes) — всегда
+    if codes is None and not await state_backend.acquire_lock("fiat_history", FIAT_HISTORY_SYNC_INTERVAL / 2):
+        return
+    if _fiat_history_lock is None:
+        _fiat_history_lock = asyncio.Lock()
+    async with _fiat_history_lock:
+        valute = (await get_cbr_data())['Valute']
+        today = datetime.today().date()
+        start = today - timedelta(days=FIAT_HISTORY_DAYS)
+        # ЦБ публикует курс на следующий рабочий день заранее
+        end = today + timedelta(days=1)
+        bounds = {code: (first, last) for code, first, last in
+                  await db_fetchall('SELECT code, MIN(date), MAX(date) FROM fiat_rates GROUP BY code')}
+        ranges = []
+        for code in codes or fiat_info:
+            if code == "RUB" or code not in valute:
+                continue
+            first, last = bounds.get(code, (None, None))
+            if first is None:
+                ranges.append((code, start, end))
+                continue
+            first = datetime.strptime(first, '%Y-%m-%d').date()
+            last = datetime.strptime(last, '%Y-%m-%d').date()
+            if first > start:
+                ranges.append((code, start, first - timedelta(days=1)))
+            if last < end:
+                ranges.append((code, last + timedelta(days=1), end))
+        results = await asyncio.gather(*(fetch_cbr_dynamic(valute[code]['ID'], range_start, range_end)
+                                         for code, range_start, range_end in ranges), return_exceptions=True)
+        rows = []
+        for (code, _, _), result in zip(ranges, results):
+            if isinstance(result, Exception):
+                print(f"Не удалось загрузить историю курса {code}: {result}")
+                continue
+            rows.extend((day, code, rate) for day, rate in result)
+        if rows:
+            await db_executemany('INSERT OR REPLACE INTO fiat_rates (date, code, rate) VALUES (?, ?, ?)', rows)
+
+
+# Матрица курсов (даты × валюты) в рублях за единицу; для RUB столбец из единиц.
+# Курс base → quote на каждую дату — отношение двух столбцов
+async def load_fiat_history(codes, start_date: str):
+    codes = list(dict.fromkeys(codes))
+    stored = [c for c in codes if c != "RUB"]
+    rows = await db_fetchall(
+        f"SELECT date, code, rate FROM fiat_rates WHERE date >= ? AND code IN ({', '.join('?' * len(stored))})",
+        (start_date, *stored)) if stored else []
+    dates = np.unique([r[0] for r in rows]) if rows else np.array([], dtype=str)
+    matrix = np.full((len(dates), len(codes)), np.nan)
+    index = {code: i for i, code in enumerate(codes)}
+    if rows:
+        row_idx = np.searchsorted(dates, [r[0] for r in rows])
+        col_idx = np.array([index[r[1]] for r in rows])
+        matrix[row_idx, col_idx] = [r[2] for r in rows]
+    if "RUB" in index:
+        matrix[:, index["RUB"]] = 1.0
+    return dates, index, matrix
+
+
+async def get_fiat_cross_series(base: str, quote: str, start_date: str):
+    dates, index, matrix = await load_fiat_history([base, quote], start_date)
+    series = matrix[:, index[base]] / matrix[:, index[quote]]
+    mask = ~np.isnan(series)
+    return dates[mask], series[mask]
+
+
+def cbr_rate_index(cur: str) -> int:
+    if cur not in _cbr_index:
+        raise Exception(f"Нет курса ЦБ для {cur}")
+    return _cbr_index[cur]
+
+
 # Функция конвертации фиатных валют с учётом Nominal (с кэшированием ЦБ)
-def convert_fiat_value(value: float, from_cur: str, to_cur: str) -> float:
-    data = get_cbr_data()
+async def convert_fiat_value(value: float, from_cur: str, to_cur: str) -> float:
+    await get_cbr_data()
+    return value * float(_cbr_matrix[cbr_rate_index(from_cur), cbr_rate_index(to_cur)])
 
-    def get_rate(cur):
-        return 1.0 if cur == "RUB" else data['Valute'][cur]['Value'] / data['Valute'][cur]['Nominal']
 
-    rub_value = value * get_rate(from_cur)
-    return rub_value if to_cur == "RUB" else rub_value / get_rate(to_cur)
+# Конвертация сразу нескольких валют в одну — один срез столбца матрицы
+async def convert_fiat_values(value: float, from_curs, to_cur: str) -> np.ndarray:
+    await get_cbr_data()
+    rows = [cbr_rate_index(cur) for cur in from_curs]
+    return value * _cbr_matrix[rows, cbr_rate_index(to_cur)]
 
 
-# Функция получения цены криптовалюты с выбранного источника
-def get_crypto_price_api(crypto: str, source: str) -> float:
+# Функция получения цены криптовалюты с выбранного источника (прямой запрос к бирже)
+async def fetch_crypto_price(crypto: str, source: str) -> float:
     if source == "BINANCE":
-        resp = session.get(f"{BINANCE_API_URL}?symbol={crypto}USDT", timeout=3)
-        data = resp.json()
+        data = await http_get_json(f"{BINANCE_API_URL}?symbol={crypto}USDT", timeout=3)
         if 'price' not in data:
             raise Exception("Пара не найдена")
         return float(data['price'])
     elif source == "GATEIO":
         url = f"https://api.gateio.ws/api/v4/spot/tickers?currency_pair={crypto}_USDT"
-        resp = session.get(url, timeout=3)
-        data = resp.json()
+        data = await http_get_json(url, timeout=3)
         if not data:
             raise Exception("Нет данных с Gate.io")
         return float(data[0]['last'])
@@ -192,8 +1022,7 @@ def get_crypto_price_api(crypto: str, source: str) -> float:
         if crypto == "SHIB":
             raise Exception("ByBit не поддерживает SHIB")
         url = f"https://api.bybit.com/spot/v1/ticker/24hr?symbol={crypto}USDT"
-        resp = session.get(url, timeout=3)
-        data = resp.json()
+        data = await http_get_json(url, timeout=3)
         if data.get("ret_code", -1) != 0:
             raise Exception("Ошибка от ByBit")
         return float(data["result"]["lastPrice"])
@@ -201,16 +1030,348 @@ def get_crypto_price_api(crypto: str, source: str) -> float:
         raise Exception("Неизвестный источник данных")
 
 
+# Снимки всех USDT-пар по каждой бирже: один запрос на биржу вместо запроса на каждый код.
+# {source: {"prices": {crypto: price}, "timestamp": t}}, обновляются фоновой задачей
+_ticker_snapshots = {}
+
+
+async def fetch_ticker_snapshot(source: str) -> dict:
+    prices = {}
+    if source == "BINANCE":
+        data = await http_get_json(BINANCE_API_URL, timeout=5)
+        for item in data:
+            if item['symbol'].endswith("USDT"):
+                prices[item['symbol'][:-4]] = float(item['price'])
+    elif source == "GATEIO":
+        data = await http_get_json("https://api.gateio.ws/api/v4/spot/tickers", timeout=5)
+        for item in data:
+            base, _, quote = item['currency_pair'].partition("_")
+            if quote == "USDT" and item.get('last'):
+                prices[base] = float(item['last'])
+    elif source == "BYBIT":
+        data = await http_get_json("https://api.bybit.com/spot/v1/ticker/24hr", timeout=5)
+        if data.get("ret_code", -1) != 0:
+            raise Exception("Ошибка от ByBit")
+        for item in data["result"]:
+            if item['symbol'].endswith("USDT") and item.get('lastPrice'):
+                prices[item['symbol'][:-4]] = float(item['lastPrice'])
+    else:
+        raise Exception("Неизвестный источник данных")
+    return prices
+
+
+async def refresh_source_snapshot(source: str):
+    key = f"snapshot:{source}"
+    shared = await state_backend.get(key)
+    if shared is not None:
+        local = _ticker_snapshots.get(source)
+        if local is None or shared["timestamp"] > local["timestamp"]:
+            _ticker_snapshots[source] = shared  # снимок уже получил другой экземпляр
+        if time.time() - shared["timestamp"] < TICKER_SNAPSHOT_INTERVAL / 2:
+            return
+    if not await state_backend.acquire_lock(key, TICKER_SNAPSHOT_INTERVAL / 2):
+        return
+    prices = await fetch_ticker_snapshot(source)
+    if prices:
+        snapshot = {"prices": prices, "timestamp": time.time()}
+        _ticker_snapshots[source] = snapshot
+        await state_backend.set(key, snapshot, ttl=TICKER_SNAPSHOT_MAX_AGE)
+
+
+async def refresh_ticker_snapshots(context: ContextTypes.DEFAULT_TYPE = None):
+    results = await asyncio.gather(*(refresh_source_snapshot(source) for source in CRYPTO_SOURCES),
+                                   return_exceptions=True)
+    for source, result in zip(CRYPTO_SOURCES, results):
+        if isinstance(result, Exception):
+            print(f"Не удалось обновить снимок цен {source}: {result}")
+
+
+def get_snapshot_price(crypto: str, source: str):
+    snapshot = _ticker_snapshots.get(source)
+    if snapshot is None or time.time() - snapshot["timestamp"] > TICKER_SNAPSHOT_MAX_AGE:
+        return None
+    return snapshot["prices"].get(crypto)
+
+
+# Потоковые цены через WebSocket бирж (опционально, нужен пакет websockets).
+# Подписка оформляется только на реально запрашиваемые коды; давно не запрашиваемые
+# отписываются. Цена из потока старше STREAM_MAX_AGE не используется — тогда идём в REST
+_stream_prices = {}  # {(source, crypto): (price, timestamp)}
+_stream_symbols = {source: {} for source in STREAM_URLS}  # {source: {crypto: время последнего запроса}}
+_stream_connections = {}  # {source: открытое соединение}
+_stream_tasks = []
+_stream_send_tasks = set()  # держим ссылки, чтобы фоновые подписки не собрал сборщик мусора
+
+
+def stream_subscription_messages(source: str, cryptos, subscribe: bool = True) -> list:
+    cryptos = sorted(cryptos)
+    if not cryptos:
+        return []
+    if source == "BINANCE":
+        return [{"method": "SUBSCRIBE" if subscribe else "UNSUBSCRIBE",
+                 "params": [f"{c.lower()}usdt@miniTicker" for c in cryptos], "id": int(time.time() * 1000)}]
+    if source == "GATEIO":
+        return [{"time": int(time.time()), "channel": "spot.tickers",
+                 "event": "subscribe" if subscribe else "unsubscribe", "payload": [f"{c}_USDT" for c in cryptos]}]
+    if source == "BYBIT":
+        # ByBit принимает не больше 10 топиков в одном запросе
+        return [{"op": "subscribe" if subscribe else "unsubscribe",
+                 "args": [f"tickers.{c}USDT" for c in cryptos[i:i + 10]]} for i in range(0, len(cryptos), 10)]
+    return []
+
+
+def parse_stream_message(source: str, message: dict) -> list:
+    if source == "BINANCE" and message.get("e") == "24hrMiniTicker" and message["s"].endswith("USDT"):
+        return [(message["s"][:-4], float(message["c"]))]
+    if source == "GATEIO" and message.get("channel") == "spot.tickers" and message.get("event") == "update":
+        result = message["result"]
+        return [(result["currency_pair"].partition("_")[0], float(result["last"]))]
+    if source == "BYBIT" and str(message.get("topic", "")).startswith("tickers."):
+        data = message["data"]
+        return [(data["symbol"][:-4], float(data["lastPrice"]))]
+    return []
+
+
+async def send_stream_messages(source: str, messages):
+    ws = _stream_connections.get(source)
+    if ws is None:
+        return
+    try:
+        for message in messages:
+            await ws.send(json.dumps(message))
+    except Exception as e:
+        print(f"Не удалось отправить подписку {source}: {e}")
+
+
+def mark_stream_symbol(crypto: str, source: str):
+    symbols = _stream_symbols.get(source)
+    if symbols is None:
+        return
+    is_new = crypto not in symbols
+    symbols[crypto] = time.time()
+    if is_new:
+        task = asyncio.create_task(send_stream_messages(source, stream_subscription_messages(source, [crypto])))
+        _stream_send_tasks.add(task)
+        task.add_done_callback(_stream_send_tasks.discard)
+
+
+def get_stream_price(crypto: str, source: str):
+    entry = _stream_prices.get((source, crypto))
+    if entry is None or time.time() - entry[1] > STREAM_MAX_AGE:
+        return None
+    return entry[0]
+
+
+async def run_price_stream(source: str):
+    while True:
+        try:
+            async with websockets.connect(STREAM_URLS[source]) as ws:
+                _stream_connections[source] = ws
+                await send_stream_messages(source, stream_subscription_messages(source, _stream_symbols[source]))
+                async for raw in ws:
+                    now = time.time()
+                    for crypto, price in parse_stream_message(source, json.loads(raw)):
+                        _stream_prices[(source, crypto)] = (price, now)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Поток цен {source} прерван: {e}")
+        finally:
+            _stream_connections.pop(source, None)
+        await asyncio.sleep(STREAM_RECONNECT_DELAY)
+
+
+async def prune_stream_symbols(context: ContextTypes.DEFAULT_TYPE = None):
+    cutoff = time.time() - STREAM_SYMBOL_IDLE
+    for source, symbols in _stream_symbols.items():
+        idle = [crypto for crypto, last_used in symbols.items() if last_used < cutoff]
+        for crypto in idle:
+            del symbols[crypto]
+            _stream_prices.pop((source, crypto), None)
+        await send_stream_messages(source, stream_subscription_messages(source, idle, subscribe=False))
+
+
+def start_price_streams():
+    if not STREAMING_ENABLED:
+        return
+    if websockets is None:
+        print("Потоковые цены отключены: не установлен пакет websockets")
+        return
+    for source in STREAM_URLS:
+        _stream_tasks.append(asyncio.create_task(run_price_stream(source)))
+
+
+async def stop_price_streams():
+    for task in _stream_tasks:
+        task.cancel()
+    await asyncio.gather(*_stream_tasks, return_exceptions=True)
+    _stream_tasks.clear()
+
+
+# Кэш цен криптовалют {(source, crypto): (price, timestamp)} с TTL и LRU-вытеснением.
+# Одновременные промахи по одному ключу ждут один общий запрос к бирже
+_price_cache = OrderedDict()
+_price_inflight = {}  # {(source, crypto): asyncio.Task}
+
+
+async def _fetch_and_cache_price(crypto: str, source: str) -> float:
+    shared = await state_backend.get(f"price:{source}:{crypto}") if state_backend.shared else None
+    if shared is not None:
+        price, timestamp = shared
+    else:
+        started = time.perf_counter()
+        try:
+            price = await fetch_crypto_price(crypto, source)
+        except Exception:
+            record_source_result(source, time.perf_counter() - started, False)
+            raise
+        record_source_result(source, time.perf_counter() - started, True)
+        timestamp = time.time()
+        if state_backend.shared:
+            await state_backend.set(f"price:{source}:{crypto}", [price, timestamp], ttl=PRICE_CACHE_TTL)
+    key = (source, crypto)
+    _price_cache[key] = (price, timestamp)
+    _price_cache.move_to_end(key)
+    while len(_price_cache) > PRICE_CACHE_MAX_SIZE:
+        _price_cache.popitem(last=False)
+    return price
+
+
+def _price_fetch_done(key, task: asyncio.Task):
+    _price_inflight.pop(key, None)
+    if not task.cancelled():
+        task.exception()  # ошибку уже получили ожидающие, не логируем её повторно
+
+
+async def get_crypto_price_api(crypto: str, source: str) -> float:
+    if STREAMING_ENABLED:
+        mark_stream_symbol(crypto, source)
+        price = get_stream_price(crypto, source)
+        if price is not None:
+            metric_inc("cache_requests_total", cache="price", result="stream")
+            return price
+    price = get_snapshot_price(crypto, source)
+    if price is not None:
+        metric_inc("cache_requests_total", cache="price", result="snapshot")
+        return price
+    key = (source, crypto)
+    cached = _price_cache.get(key)
+    if cached is not None and time.time() - cached[1] <= PRICE_CACHE_TTL:
+        metric_inc("cache_requests_total", cache="price", result="hit")
+        _price_cache.move_to_end(key)
+        return cached[0]
+    task = _price_inflight.get(key)
+    metric_inc("cache_requests_total", cache="price", result="miss" if task is None else "coalesced")
+    if task is None:
+        task = asyncio.create_task(_fetch_and_cache_price(crypto, source))
+        task.add_done_callback(lambda t: _price_fetch_done(key, t))
+        _price_inflight[key] = task
+    # shield: отмена одного из ожидающих не должна прерывать общий запрос
+    return await asyncio.shield(task)
+
+
+# Маршрутизация между биржами: по каждой бирже копится статистика задержек и ошибок.
+# Если выбранная биржа не ответила за «обычное» для неё время (перцентиль задержек),
+# параллельно отправляется страхующий запрос к следующей по надёжности бирже;
+# при ошибке — сразу переключаемся на неё. Побеждает первый успешный ответ;
+# возвращается (цена, биржа, множество бирж, ответивших ошибкой)
+_source_latencies = {source: deque(maxlen=SOURCE_STATS_WINDOW) for source in CRYPTO_SOURCES}
+_source_errors = {source: deque(maxlen=SOURCE_STATS_WINDOW) for source in CRYPTO_SOURCES}  # 1 — ошибка
+
+
+def record_source_result(source: str, latency: float, ok: bool):
+    metric_inc("price_source_requests_total", source=source, result="ok" if ok else "error")
+    if ok:
+        metric_observe("price_source_duration_seconds", latency, source=source)
+    if source in _source_latencies:
+        _source_errors[source].append(0 if ok else 1)
+        if ok:
+            _source_latencies[source].append(latency)
+
+
+def source_error_rate(source: str) -> float:
+    errors = _source_errors.get(source)
+    return sum(errors) / len(errors) if errors else 0.0
+
+
+def hedge_delay(source: str) -> float:
+    latencies = _source_latencies.get(source)
+    if not latencies or len(latencies) < 10:
+        return HEDGE_DEFAULT_DELAY
+    delay = float(np.percentile(latencies, HEDGE_PERCENTILE))
+    return min(max(delay, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+
+def rank_sources(preferred: str) -> list:
+    def score(source):
+        latencies = _source_latencies[source]
+        return source_error_rate(source), float(np.median(latencies)) if latencies else HEDGE_DEFAULT_DELAY
+    return [preferred] + sorted((s for s in CRYPTO_SOURCES if s != preferred), key=score)
+
+
+async def get_crypto_price_routed(crypto: str, preferred: str):
+    candidates = rank_sources(preferred) if preferred in CRYPTO_SOURCES else [preferred]
+    pending = {}
+    errors = []
+    failed = set()  # биржи, ответившие ошибкой (остальные проигравшие — просто медленнее)
+
+    def launch():
+        source = candidates[len(pending) + len(errors)]
+        pending[asyncio.create_task(get_crypto_price_api(crypto, source))] = source
+        return source
+
+    last_source = launch()
+    try:
+        while pending:
+            has_spare = len(pending) + len(errors) < len(candidates)
+            done, _ = await asyncio.wait(pending, timeout=hedge_delay(last_source) if has_spare else None,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                last_source = launch()
+                continue
+            for task in done:
+                source = pending.pop(task)
+                if task.exception() is None:
+                    return task.result(), source, failed
+                errors.append(task.exception())
+                failed.add(source)
+            if not pending and len(errors) < len(candidates):
+                last_source = launch()
+    finally:
+        for task in pending:
+            task.cancel()
+    raise errors[0]
+
+
+# Параллельный опрос нескольких источников с общим дедлайном.
+# Источники, не ответившие вовремя или вернувшие ошибку, получают None
+async def fetch_prices_concurrently(crypto: str, sources, deadline: float) -> dict:
+    tasks = {source: asyncio.create_task(get_crypto_price_api(crypto, source)) for source in sources}
+    await asyncio.wait(tasks.values(), timeout=deadline)
+    results = {}
+    for source, task in tasks.items():
+        if task.done() and not task.cancelled() and task.exception() is None:
+            results[source] = task.result()
+        else:
+            task.cancel()
+            results[source] = None
+    return results
+
+
 # Конвертация криптовалют
 async def convert_crypto_command(update: Update, context: ContextTypes.DEFAULT_TYPE, crypto: str, target_currency: str):
-    settings = load_user_settings(update.effective_user.id)
+    settings = await load_user_settings(update.effective_user.id)
     source = settings.get("data_source", "BINANCE")
     try:
-        usd_price = get_crypto_price_api(crypto, source)
-        price = usd_price if target_currency == "USD" else convert_fiat_value(usd_price, "USD", target_currency)
+        usd_price, used_source, failed = await get_crypto_price_routed(crypto, source)
+        price = usd_price if target_currency == "USD" else await convert_fiat_value(usd_price, "USD", target_currency)
         price_str = f"{price:,.8f}" if price < 0.01 else f"{price:,.2f}"
+        note = cbr_staleness_note() if target_currency != "USD" else ""
+        if used_source != source:
+            reason = "вернул ошибку" if source in failed else "не ответил вовремя"
+            note = f" (резерв: {source} {reason})" + note
         await tracked_reply(update,
-                            f"🪙 {crypto}\nЦена: {price_str} {target_currency}\nИсточник: {source}",
+                            f"🪙 {crypto}\nЦена: {price_str} {target_currency}\nИсточник: {used_source}{note}",
                             parse_mode="HTML")
     except Exception as e:
         await tracked_reply(update, f"❌ Ошибка: {str(e)}", parse_mode="HTML")
@@ -219,9 +1380,10 @@ async def convert_crypto_command(update: Update, context: ContextTypes.DEFAULT_T
 # Конвертация фиатных валют
 async def convert_fiat_command(update: Update, context: ContextTypes.DEFAULT_TYPE, from_cur: str, to_cur: str):
     try:
-        rate = convert_fiat_value(1, from_cur, to_cur)
+        rate = await convert_fiat_value(1, from_cur, to_cur)
         await tracked_reply(update,
-                            f"💵 {from_cur} → {to_cur}\nКурс: 1 {from_cur} = {rate:,.2f} {to_cur}\nИсточник: ЦБ РФ",
+                            f"💵 {from_cur} → {to_cur}\nКурс: 1 {from_cur} = {rate:,.2f} {to_cur}\nИсточник: ЦБ РФ"
+                            f"{cbr_staleness_note()}",
                             parse_mode="HTML")
     except Exception as e:
         await tracked_reply(update, f"❌ Ошибка: {str(e)}", parse_mode="HTML")
@@ -233,12 +1395,14 @@ async def convert_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(args) < 1:
         return await tracked_reply(update, "Использование: /convert <Код> [Целевая]")
     from_code = args[0].upper()
-    to_code = args[1].upper() if len(args) > 1 else load_user_settings(update.effective_user.id).get("default_currency",
-                                                                                                     "USD")
+    settings = await load_user_settings(update.effective_user.id)
+    to_code = args[1].upper() if len(args) > 1 else settings.get("default_currency", "USD")
     if from_code in crypto_info:
         await convert_crypto_command(update, context, from_code, to_code)
     elif from_code in fiat_info:
         await convert_fiat_command(update, context, from_code, to_code)
+    elif await is_listed_crypto(from_code, settings.get("data_source", "BINANCE")):
+        await convert_crypto_command(update, context, from_code, to_code)
     else:
         await tracked_reply(update, f"❌ Неизвестная валюта: {from_code}")
 
@@ -263,237 +1427,107 @@ async def fiat_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await tracked_reply(update, "Выберите валюту для конвертации:", reply_markup=inline_kb)
 
 
-# Функция, которая выводит все доступные на бирже криптовалюты с названиями (используя Binance exchangeInfo)
-async def list_available_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        resp = session.get("https://api.binance.com/api/v3/exchangeInfo", timeout=5)
-        data = resp.json()
-        symbols = data.get("symbols", [])
-        crypto_set = set()
-        for sym in symbols:
-            # Отбираем только пары с USDT
-            if sym.get("quoteAsset") == "USDT":
-                crypto_set.add(sym.get("baseAsset"))
-        crypto_list = sorted(list(crypto_set))
-        text = "💹 <b>Доступные криптовалюты на бирже (пары с USDT):</b>\n\n"
-        for c in crypto_list:
-            name = crypto_info.get(c, "Название неизвестно")
-            text += f"• {c} — {name}\n"
-        await tracked_reply(update, text, parse_mode="HTML")
-    except Exception as e:
-        await tracked_reply(update, f"❌ Ошибка: {str(e)}", parse_mode="HTML")
-
+# Каталог торгуемых к USDT активов по каждой бирже. Обновляется фоновой задачей раз
+# в SYMBOL_CATALOG_TTL сек (или загружается при первом обращении); /listcrypto и
+# проверка кодов обслуживаются из памяти
+# {source: {"assets": отсортированный список, "index": set, "timestamp": t}}
+_symbol_catalog = {}
+_symbol_catalog_lock = None
 
-# Функция, которая выводит все доступные фиатные валюты (из нашего словаря)
-async def list_available_fiat(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = "💹 <b>Доступные фиатные валюты:</b>\n\n"
-    for code, name in sorted(fiat_info.items()):
-        text += f"• {code} — {name}\n"
-    await tracked_reply(update, text, parse_mode="HTML")
 
-
-# Функция, которая выводит цены на криптовалюту на разных платформах и разницу между ценами
-async def compare_crypto_prices(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def fetch_symbol_catalog(source: str) -> set:
+    if source == "BINANCE":
+        data = await http_get_json("https://api.binance.com/api/v3/exchangeInfo", timeout=5)
+        return {s["baseAsset"] for s in data.get("symbols", [])
+                if s.get("quoteAsset") == "USDT" and s.get("status", "TRADING") == "TRADING"}
+    if source == "GATEIO":
+        data = await http_get_json("https://api.gateio.ws/api/v4/spot/currency_pairs", timeout=5)
+        return {p["base"] for p in data if p.get("quote") == "USDT" and p.get("trade_status") == "tradable"}
+    if source == "BYBIT":
+        data = await http_get_json("https://api.bybit.com/spot/v1/symbols", timeout=5)
+        if data.get("ret_code", -1) != 0:
+            raise Exception("Ошибка от ByBit")
+        return {s["baseCurrency"] for s in data["result"] if s.get("quoteCurrency") == "USDT"}
+    raise Exception("Неизвестный источник данных")
+
+
+async def refresh_symbol_catalog(context: ContextTypes.DEFAULT_TYPE = None, sources=None):
+    to_fetch = []
+    for source in sources or CRYPTO_SOURCES:
+        shared = await state_backend.get(f"catalog:{source}")
+        if shared is not None:
+            local = _symbol_catalog.get(source)
+            if local is None or shared["timestamp"] > local["timestamp"]:  # список уже получил другой экземпляр
+                _symbol_catalog[source] = {"assets": shared["assets"], "index": set(shared["assets"]),
+                                           "timestamp": shared["timestamp"]}
+            if time.time() - shared["timestamp"] < SYMBOL_CATALOG_TTL / 2:
+                continue
+        # Без блокировки загружаем только по требованию, если списка ещё нет совсем
+        if (await state_backend.acquire_lock(f"catalog:{source}", SYMBOL_CATALOG_TTL / 2)
+                or (context is None and source not in _symbol_catalog)):
+            to_fetch.append(source)
+    results = await asyncio.gather(*(fetch_symbol_catalog(source) for source in to_fetch), return_exceptions=True)
+    now = time.time()
+    for source, assets in zip(to_fetch, results):
+        if isinstance(assets, Exception):
+            print(f"Не удалось обновить список активов {source}: {assets}")
+        elif assets:
+            _symbol_catalog[source] = {"assets": sorted(assets), "index": assets, "timestamp": now}
+            await state_backend.set(f"catalog:{source}", {"assets": _symbol_catalog[source]["assets"],
+                                                          "timestamp": now})
+
+
+async def get_symbol_catalog(source: str) -> list:
+    global _symbol_catalog_lock
+    if source not in _symbol_catalog:
+        if _symbol_catalog_lock is None:
+            _symbol_catalog_lock = asyncio.Lock()
+        async with _symbol_catalog_lock:
+            if source not in _symbol_catalog:
+                await refresh_symbol_catalog(sources=[source])
+    if source not in _symbol_catalog:
+        raise Exception("Список активов биржи недоступен")
+    return _symbol_catalog[source]["assets"]
+
+
+# Код проверяется по каталогу биржи пользователя; если каталог ещё не загружен
+# (нет JobQueue или фоновое обновление не успело пройти), он подгружается по требованию
+async def is_listed_crypto(code: str, source: str) -> bool:
+    if code in crypto_info:
+        return True
     try:
-        crypto = context.args[0].upper()
-    except:
-        return await tracked_reply(update, "Использование: /compare <Код> (например, /compare BTC)", parse_mode="HTML")
-    results = {}
-    sources = ["BINANCE", "GATEIO", "BYBIT"]
-    for source in sources:
-        try:
-            price = get_crypto_price_api(crypto, source)
-            results[source] = price
-        except Exception as e:
-            results[source] = None
-    text = f"📊 <b>Сравнение цен для {crypto}:</b>\n\n"
-    valid_prices = {}
-    for source, price in results.items():
-        if price is not None:
-            valid_prices[source] = price
-            text += f"• {source}: {price:,.2f} USD\n"
-        else:
-            text += f"• {source}: Нет данных\n"
-    if valid_prices:
-        max_price = max(valid_prices.values())
-        min_price = min(valid_prices.values())
-        diff = max_price - min_price
-        pct = (diff / min_price * 100) if min_price != 0 else 0
-        text += f"\nРазница: {diff:,.2f} USD ({pct:+.2f}%)"
-    else:
-        text += "\nНет данных для сравнения."
-    await tracked_reply(update, text, parse_mode="HTML")
+        await get_symbol_catalog(source)
+    except Exception:
+        return False
+    return code in _symbol_catalog[source]["index"]
 
 
-# Команда /check
-async def check_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        code = context.args[0].upper()
-        if code in fiat_info:
-            info = f"💵 {code}: {fiat_info[code]}"
-        elif code in crypto_info:
-            info = f"🪙 {code}: {crypto_info[code]}"
-        else:
-            info = f"❓ Нет данных для кода {code}"
-    except:
-        info = "Использование: /check <Код> (например, /check USD)"
-    await tracked_reply(update, info, parse_mode="HTML")
+# Списки бирж длинные (у Gate.io около 2000 пар) — /listcrypto показывает их постранично
+# с кнопками ◀️/▶️, а не десятками сообщений подряд, упираясь в лимит Telegram
+LISTCRYPTO_PAGE_SIZE = 80  # активов на странице, чтобы текст уложился в 4096 символов
 
 
-# Команда /trend – поддержка периода с единицами (m, h, d, mo, y)
-async def trend_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        code = context.args[0].upper()
-    except:
-        return await tracked_reply(update,
-                                   "Использование: /trend <Код> [Период] (например, /trend BTC 24h или /trend EUR 1y)",
-                                   parse_mode="HTML")
-    if len(context.args) > 1:
-        period_arg = context.args[1]
-        num_part = ''.join(filter(str.isdigit, period_arg))
-        unit_part = ''.join(filter(str.isalpha, period_arg)).lower()
-        period_value = int(num_part) if num_part else 0
-        if unit_part in {"m", "min"}:
-            time_unit = "minutes"
-        elif unit_part == "h":
-            time_unit = "hours"
-        elif unit_part == "d":
-            time_unit = "days"
-        elif unit_part in {"mo", "month", "months"}:
-            time_unit = "months"
-        elif unit_part in {"y", "year", "years"}:
-            time_unit = "years"
-        else:
-            time_unit = "days"
-    else:
-        if code in crypto_info:
-            period_value, time_unit = 24, "hours"
-        elif code in fiat_info:
-            period_value, time_unit = 30, "days"
-        else:
-            return await tracked_reply(update, f"❓ Нет данных для кода {code}", parse_mode="HTML")
-    processing_msg = await tracked_reply(update,
-                                         f"⏳ Обработка запроса для {code} за последние {period_value} {time_unit}...",
-                                         parse_mode="HTML")
-    if code in crypto_info:
-        settings = load_user_settings(update.effective_user.id)
-        source = settings.get("data_source", "BINANCE")
-        if source == "BINANCE":
-            if time_unit in {"minutes", "hours"} and ((time_unit == "minutes" and period_value < 60 * 48) or (
-                    time_unit == "hours" and period_value < 48)):
-                interval = "1m" if time_unit == "minutes" else "1h"
-                limit = period_value
-            else:
-                interval = "1d"
-                if time_unit == "days":
-                    limit = period_value
-                elif time_unit == "months":
-                    limit = period_value * 30
-                elif time_unit == "years":
-                    limit = period_value * 365
-                else:
-                    limit = period_value
-            url = f"https://api.binance.com/api/v3/klines?symbol={code}USDT&interval={interval}&limit={limit}"
-            data = session.get(url, timeout=5).json()
-            if not data or not isinstance(data, list):
-                return await processing_msg.edit_text("❌ Нет данных для графика", parse_mode="HTML")
-            date_format = '%H:%M' if interval in {"1m", "1h"} else '%d-%m'
-            dates = [datetime.fromtimestamp(entry[0] / 1000).strftime(date_format) for entry in data]
-            prices = [float(entry[4]) for entry in data]
-        elif source in {"GATEIO", "BYBIT"}:
-            interval = "1d"
-            if time_unit in {"days", "months", "years"}:
-                if time_unit == "days":
-                    limit = period_value
-                elif time_unit == "months":
-                    limit = period_value * 30
-                elif time_unit == "years":
-                    limit = period_value * 365
-                else:
-                    limit = period_value
-            else:
-                limit = 24
-            url = f"https://api.binance.com/api/v3/klines?symbol={code}USDT&interval={interval}&limit={limit}"
-            data = session.get(url, timeout=5).json()
-            dates = [datetime.fromtimestamp(entry[0] / 1000).strftime('%d-%m') for entry in data]
-            prices = [float(entry[4]) for entry in data]
-        pct_change = ((prices[-1] - prices[0]) / prices[0]) * 100
-        caption = f"📈 {code} за последние {period_value} {time_unit}\nИзменение: {pct_change:+.2f}%\nИсточник: {source}"
-    elif code in fiat_info:
-        if time_unit in {"minutes", "hours"}:
-            days = 1
-        elif time_unit == "days":
-            days = period_value
-        elif time_unit == "months":
-            days = period_value * 30
-        elif time_unit == "years":
-            days = period_value * 365
-        else:
-            days = period_value
-        end_date = datetime.today()
-        start_date = end_date - timedelta(days=days - 1)
-        start_str = start_date.strftime('%Y-%m-%d')
-        end_str = end_date.strftime('%Y-%m-%d')
-        default = load_user_settings(update.effective_user.id)['default_currency']
-        url = f"https://api.exchangerate.host/timeseries?start_date={start_str}&end_date={end_str}&base={code}&symbols={default}"
-        data_json = session.get(url, timeout=5).json()
-        rates = data_json.get("rates", {})
-        if not rates:
-            return await processing_msg.edit_text("❌ Нет данных для графика", parse_mode="HTML")
-        sorted_dates = sorted(rates.keys())
-        dates = [datetime.strptime(d, '%Y-%m-%d').strftime('%d-%m') for d in sorted_dates]
-        prices = [rates[d][default] for d in sorted_dates]
-        pct_change = ((prices[-1] - prices[0]) / prices[0]) * 100
-        caption = f"📈 {code} → {default} за {days} дн.\nИзменение: {pct_change:+.2f}%\nИсточник: exchangerate.host"
-    else:
-        return await processing_msg.edit_text(f"❓ Нет данных для кода {code}", parse_mode="HTML")
-    x = np.arange(len(prices))
-    slope, intercept = np.polyfit(x, prices, 1)
-    trend_line = slope * x + intercept
-    plt.figure(figsize=(10, 6))
-    plt.plot(x, prices, marker='o', linestyle='-', color='blue', label='Цена')
-    plt.plot(x, trend_line, color='red', linestyle='--', linewidth=2, label='Тренд')
-    plt.plot(x[-1], trend_line[-1], 'ro', markersize=5)
-    plt.title(f"{code} – тренд")
-    plt.xlabel("Время")
-    ylabel = "Цена (USDT)" if code in crypto_info else f"Цена ({default})"
-    plt.ylabel(ylabel)
-    plt.legend()
-    plt.grid(True)
-    if len(x) > 12:
-        indices = np.linspace(0, len(x) - 1, num=12, dtype=int)
-        plt.xticks(indices, [dates[i] for i in indices], rotation=45)
-    else:
-        plt.xticks(x, dates, rotation=45)
-    plt.tight_layout()
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
-    plt.close()
-    try:
-        await processing_msg.edit_media(media=InputMediaPhoto(media=buf, caption=caption, parse_mode="HTML"))
-    except Exception as e:
-        target = get_reply_target(update)
-        if target:
-            await target.reply_photo(photo=buf, caption=caption, parse_mode="HTML")
+def render_crypto_page(source: str, assets: list, page: int):
+    pages = max(1, math.ceil(len(assets) / LISTCRYPTO_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    start = page * LISTCRYPTO_PAGE_SIZE
+    lines = [f"💹 <b>Доступные криптовалюты на {source} (пары с USDT), стр. {page + 1}/{pages}:</b>\n"]
+    lines.extend(f"• {c} — {crypto_info.get(c, 'Название неизвестно')}"
+                 for c in assets[start:start + LISTCRYPTO_PAGE_SIZE])
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"listcrypto_{source}_{page - 1}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"listcrypto_{source}_{page + 1}"))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
 
 
-# Команда /listcrypto – вывод всех доступных криптовалют с названиями (из Binance exchangeInfo)
+# Команда /listcrypto – вывод всех доступных криптовалют с названиями
 async def list_available_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        resp = session.get("https://api.binance.com/api/v3/exchangeInfo", timeout=5)
-        data = resp.json()
-        symbols = data.get("symbols", [])
-        crypto_set = set()
-        for sym in symbols:
-            if sym.get("quoteAsset") == "USDT":
-                crypto_set.add(sym.get("baseAsset"))
-        crypto_list = sorted(list(crypto_set))
-        text = "💹 <b>Доступные криптовалюты (пары с USDT):</b>\n\n"
-        for c in crypto_list:
-            name = crypto_info.get(c, "Название неизвестно")
-            text += f"• {c} — {name}\n"
-        await tracked_reply(update, text, parse_mode="HTML")
+        source = (await load_user_settings(update.effective_user.id)).get("data_source", "BINANCE")
+        text, inline_kb = render_crypto_page(source, await get_symbol_catalog(source), 0)
+        await tracked_reply(update, text, parse_mode="HTML", reply_markup=inline_kb)
     except Exception as e:
         await tracked_reply(update, f"❌ Ошибка: {str(e)}", parse_mode="HTML")
 
@@ -506,20 +1540,13 @@ async def list_available_fiat(update: Update, context: ContextTypes.DEFAULT_TYPE
     await tracked_reply(update, text, parse_mode="HTML")
 
 
-# Команда /compare – вывод цен на криптовалюту на разных платформах и разница между ценами
+# Команда /compare – вывод цен криптовалюты на разных платформах и разница между ценами
 async def compare_crypto_prices(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         crypto = context.args[0].upper()
     except:
         return await tracked_reply(update, "Использование: /compare <Код> (например, /compare BTC)", parse_mode="HTML")
-    results = {}
-    sources = ["BINANCE", "GATEIO", "BYBIT"]
-    for source in sources:
-        try:
-            price = get_crypto_price_api(crypto, source)
-            results[source] = price
-        except Exception as e:
-            results[source] = None
+    results = await fetch_prices_concurrently(crypto, CRYPTO_SOURCES, COMPARE_DEADLINE)
     text = f"📊 <b>Сравнение цен для {crypto}:</b>\n\n"
     valid_prices = {}
     for source, price in results.items():
@@ -533,268 +1560,324 @@ async def compare_crypto_prices(update: Update, context: ContextTypes.DEFAULT_TY
         min_price = min(valid_prices.values())
         diff = max_price - min_price
         pct = (diff / min_price * 100) if min_price != 0 else 0
-        text += f"\nРазница между максимальной и минимальной ценой: {diff:,.2f} USD ({pct:+.2f}%)"
+        text += f"\nРазница: {diff:,.2f} USD ({pct:+.2f}%)"
     else:
         text += "\nНет данных для сравнения."
     await tracked_reply(update, text, parse_mode="HTML")
 
 
-# Команды подписки и прочие
-async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        pair = context.args[0].upper()
-        db_execute('INSERT OR IGNORE INTO subscriptions (user_id, pair) VALUES (?, ?)',
-                   (update.effective_user.id, pair))
-        await tracked_reply(update, f"✅ Подписка на {pair} добавлена", parse_mode="HTML")
-    except:
-        await tracked_reply(update, "❌ Используйте: /subscribe <Пара>")
-
-
-async def show_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    subs = db_fetchall('SELECT pair FROM subscriptions WHERE user_id = ?', (update.effective_user.id,))
-    text = "📋 Ваши подписки:\n" + "\n".join([f"• {s[0]}" for s in subs]) if subs else "Нет подписок"
-    await tracked_reply(update, text)
-
-
-async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    if chat_id in bot_messages:
-        for msg_id in bot_messages[chat_id]:
-            try:
-                await context.bot.delete_message(chat_id, msg_id)
-            except:
-                pass
-        bot_messages[chat_id] = []
-    await tracked_reply(update, "🗑 История очищена")
-
-
-# Обработка inline-кнопок
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
-    data = query.data
-    if data.startswith("crypto_"):
-        await convert_crypto_command(update, context, data.split("_")[1],
-                                     load_user_settings(user_id)["default_currency"])
-    elif data.startswith("fiat_"):
-        await convert_fiat_command(update, context, data.split("_")[1])
-    elif data == "toggle_notifications":
-        settings = load_user_settings(user_id)
-        settings["notifications"] = not settings["notifications"]
-        save_user_settings(user_id, settings)
-        status = "ВКЛ" if settings["notifications"] else "ВЫКЛ"
-        await query.edit_message_text(f"⚙️ Уведомления: {status}")
-    elif data == "change_default_currency":
-        inline_kb = InlineKeyboardMarkup([[
-            InlineKeyboardButton(c, callback_data=f"set_default_{c}") for c in ["USD", "EUR", "RUB", "GBP"]
-        ]])
-        await query.edit_message_text("Выберите валюту по умолчанию:", reply_markup=inline_kb)
-    elif data.startswith("set_default_"):
-        new_currency = data.split("_")[2]
-        settings = load_user_settings(user_id)
-        settings["default_currency"] = new_currency
-        save_user_settings(user_id, settings)
-        await query.edit_message_text(f"✅ Валюта по умолчанию: {new_currency}")
-    elif data == "change_data_source":
-        inline_kb = InlineKeyboardMarkup([[
-            InlineKeyboardButton("BINANCE", callback_data="set_source_BINANCE"),
-            InlineKeyboardButton("GATEIO", callback_data="set_source_GATEIO"),
-            InlineKeyboardButton("BYBIT", callback_data="set_source_BYBIT")
-        ]])
-        await query.edit_message_text("Выберите источник данных для криптовалют:", reply_markup=inline_kb)
-    elif data.startswith("set_source_"):
-        new_source = data.split("_")[2]
-        settings = load_user_settings(user_id)
-        settings["data_source"] = new_source
-        save_user_settings(user_id, settings)
-        await query.edit_message_text(f"✅ Источник данных: {new_source}")
-    elif data in ["show_rates_fiat", "show_rates_crypto"]:
-        if "fiat" in data:
-            await handle_show_rates_fiat(update, context)
+# Локальное хранилище свечей Binance. Закрытые свечи не меняются, поэтому с биржи
+# догружается только хвост после последней сохранённой свечи (её саму перезаписываем —
+# она могла быть ещё не закрыта). Для каждой пары хранится непрерывный диапазон свечей
+BINANCE_KLINES_URL = 'https://api.binance.com/api/v3/klines'
+BINANCE_KLINES_LIMIT = 1000  # максимум свечей в одном ответе Binance
+# Сколько последних свечей хранить: самое длинное окно /trend на каждом интервале
+# (минутные — до 48 ч, часовые — до 48 ч, дальше окно укрупняется до TREND_MAX_CANDLES)
+CANDLE_KEEP = {"1m": 48 * 60, "1h": 48}
+_candle_sync_locks = {}  # {(symbol, interval): asyncio.Lock}
+
+
+# Свечи хранятся в структурированном массиве NumPy: одно преобразование JSON без
+# поэлементных циклов Python
+KLINE_DTYPE = np.dtype([("open_time", np.int64), ("open", np.float64), ("high", np.float64),
+                        ("low", np.float64), ("close", np.float64), ("volume", np.float64)])
+
+
+def parse_klines(data: list) -> np.ndarray:
+    klines = np.empty(len(data), dtype=KLINE_DTYPE)
+    if not data:
+        return klines
+    raw = np.array(data, dtype=object)[:, :6]
+    klines["open_time"] = raw[:, 0].astype(np.int64)
+    values = raw[:, 1:6].astype(np.float64)
+    for i, name in enumerate(KLINE_DTYPE.names[1:]):
+        klines[name] = values[:, i]
+    return klines
+
+
+async def _fetch_klines_chunk(symbol: str, interval: str, start_ms: int, end_ms: int) -> np.ndarray:
+    data = await http_get_json(BINANCE_KLINES_URL, params={"symbol": symbol, "interval": interval,
+                                                           "startTime": start_ms, "endTime": end_ms,
+                                                           "limit": BINANCE_KLINES_LIMIT}, timeout=5)
+    if not isinstance(data, list):
+        raise Exception(data.get("msg", "Нет данных для графика") if isinstance(data, dict) else "Нет данных")
+    return parse_klines(data)
+
+
+# Длинный диапазон делится на куски по BINANCE_KLINES_LIMIT свечей, которые
+# запрашиваются параллельно и склеиваются по времени открытия
+async def fetch_klines_range(symbol: str, interval: str, start_ms: int, end_ms: int) -> np.ndarray:
+    chunk_ms = BINANCE_KLINES_LIMIT * INTERVAL_SECONDS[interval] * 1000
+    chunks = await asyncio.gather(*(_fetch_klines_chunk(symbol, interval, chunk_start,
+                                                        min(chunk_start + chunk_ms - 1, end_ms))
+                                    for chunk_start in range(start_ms, end_ms + 1, chunk_ms)))
+    klines = np.concatenate(chunks) if chunks else np.empty(0, dtype=KLINE_DTYPE)
+    _, first_idx = np.unique(klines["open_time"], return_index=True)
+    return klines[first_idx]
+
+
+# Слишком длинные окна переводятся на более крупный интервал свечей,
+# чтобы число точек (и запросов, и время отрисовки) оставалось ограниченным
+def coarsen_kline_interval(interval: str, limit: int):
+    while limit > TREND_MAX_CANDLES and interval in KLINE_COARSER:
+        interval, factor = KLINE_COARSER[interval]
+        limit = math.ceil(limit / factor)
+    return interval, min(limit, TREND_MAX_CANDLES)
+
+
+def candle_open_time(timestamp_ms: int, interval: str) -> int:
+    step_ms = INTERVAL_SECONDS[interval] * 1000
+    offset_ms = INTERVAL_OFFSETS.get(interval, 0) * 1000
+    return (timestamp_ms - offset_ms) // step_ms * step_ms + offset_ms
+
+
+async def sync_candles(symbol: str, interval: str, window_start: int):
+    lock = _candle_sync_locks.setdefault((symbol, interval), asyncio.Lock())
+    async with lock:
+        bounds = await db_fetchall(
+            'SELECT MIN(open_time), MAX(open_time) FROM candles WHERE symbol = ? AND interval = ?', (symbol, interval))
+        first, last = bounds[0]
+        # Начало уже загруженного диапазона может быть раньше первой свечи: до листинга
+        # пары на бирже свечей нет, и повторно запрашивать этот отрезок незачем
+        synced = await db_fetchall('SELECT synced_from FROM candle_sync WHERE symbol = ? AND interval = ?',
+                                   (symbol, interval))
+        synced_from = min(synced[0][0], first) if synced and first is not None else first
+        if first is not None and synced_from <= window_start <= last:
+            fetch_from = last
         else:
-            await handle_show_rates_crypto(update, context)
-    else:
-        await query.edit_message_text("Неизвестная команда.", parse_mode="HTML")
-
+            fetch_from = synced_from = window_start
+            if last is not None and last < window_start:
+                # Старый диапазон не стыкуется с новым окном — удаляем, чтобы не было разрывов
+                await db_execute('DELETE FROM candles WHERE symbol = ? AND interval = ?', (symbol, interval))
+        klines = await fetch_klines_range(symbol, interval, fetch_from, int(time.time() * 1000))
+        if len(klines):
+            await db_executemany('''
+                INSERT OR REPLACE INTO candles (symbol, interval, open_time, open, high, low, close, volume)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [(symbol, interval) + row for row in klines.tolist()])
+            await db_execute('''
+                DELETE FROM candles WHERE symbol = ? AND interval = ? AND open_time <= (
+                    SELECT open_time FROM candles WHERE symbol = ? AND interval = ?
+                    ORDER BY open_time DESC LIMIT 1 OFFSET ?)
+            ''', (symbol, interval, symbol, interval, CANDLE_KEEP.get(interval, TREND_MAX_CANDLES)))
+            kept = await db_fetchall('SELECT MIN(open_time), COUNT(*) FROM candles WHERE symbol = ? AND interval = ?',
+                                     (symbol, interval))
+            if kept[0][1] >= CANDLE_KEEP.get(interval, TREND_MAX_CANDLES):  # начало диапазона обрезано
+                synced_from = max(synced_from, kept[0][0])
+            await db_execute('INSERT OR REPLACE INTO candle_sync (symbol, interval, synced_from) VALUES (?, ?, ?)',
+                             (symbol, interval, synced_from))
+
+
+# Свечи за последние limit интервалов в виде массива KLINE_DTYPE
+async def get_klines(symbol: str, interval: str, limit: int) -> np.ndarray:
+    step_ms = INTERVAL_SECONDS[interval] * 1000
+    current_open = candle_open_time(int(time.time() * 1000), interval)
+    window_start = current_open - (max(limit, 1) - 1) * step_ms
+    await sync_candles(symbol, interval, window_start)
+    rows = await db_fetchall('''
+        SELECT open_time, open, high, low, close, volume FROM candles
+        WHERE symbol = ? AND interval = ? AND open_time >= ?
+        ORDER BY open_time
+    ''', (symbol, interval, window_start))
+    return np.array(rows, dtype=KLINE_DTYPE)
+
+
+# Отрисовка графиков тренда в пуле процессов через объектный API matplotlib
+# (без глобального состояния pyplot), чтобы не блокировать event loop
+CHART_WORKERS = min(4, os.cpu_count() or 1)
+CHART_QUEUE_LIMIT = 16  # максимум графиков в работе и в очереди
+_chart_executor = None
+_chart_pending = 0
+
+
+# Прореживание ряда перед отрисовкой: возвращает отсортированные индексы
+# не более чем target точек. Min-max сохраняет минимум и максимум каждого отрезка
+def downsample_minmax(values: np.ndarray, target: int) -> np.ndarray:
+    n = len(values)
+    if n <= target or target < 4:
+        return np.arange(n)
+    size = math.ceil(n / (target // 2))
+    buckets = math.ceil(n / size)
+    padded = np.full(buckets * size, np.nan)
+    padded[:n] = values
+    padded = padded.reshape(buckets, size)
+    offsets = np.arange(buckets) * size
+    indices = np.concatenate(([0, n - 1], offsets + np.nanargmin(padded, axis=1),
+                              offsets + np.nanargmax(padded, axis=1)))
+    return np.unique(indices)
+
+
+# Largest-Triangle-Three-Buckets: сохраняет визуальную форму ряда
+def downsample_lttb(values: np.ndarray, target: int) -> np.ndarray:
+    n = len(values)
+    if n <= target or target < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, target - 1).astype(int)
+    indices = np.empty(target, dtype=int)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(target - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        avg_x = (next_start + next_end - 1) / 2
+        avg_y = values[next_start:next_end].mean()
+        xs = np.arange(start, end)
+        areas = np.abs((a - avg_x) * (values[start:end] - values[a]) - (a - xs) * (avg_y - values[a]))
+        a = start + int(np.argmax(areas))
+        indices[i + 1] = a
+    return indices
+
+
+def downsample_series(values: np.ndarray, target: int) -> np.ndarray:
+    if TREND_DOWNSAMPLE_METHOD == "lttb":
+        return downsample_lttb(values, target)
+    return downsample_minmax(values, target)
+
+
+# times — время точек в секундах Unix; подписи форматируются только для видимых делений оси
+def render_trend_chart(code: str, times, prices, ylabel: str, date_format: str) -> bytes:
+    prices = np.asarray(prices, dtype=np.float64)
+    x = np.arange(len(prices))
+    slope, intercept = np.polyfit(x, prices, 1)
+    trend_line = slope * x + intercept
+    shown = downsample_series(prices, TREND_MAX_POINTS)
+    fig = Figure(figsize=(10, 6))
+    ax = fig.add_subplot()
+    ax.plot(shown, prices[shown], marker='o' if len(shown) <= TREND_MARKERS_MAX_POINTS else None,
+            linestyle='-', color='blue', label='Цена')
+    ax.plot(x[[0, -1]], trend_line[[0, -1]], color='red', linestyle='--', linewidth=2, label='Тренд')
+    ax.plot(x[-1], trend_line[-1], 'ro', markersize=5)
+    ax.set_title(f"{code} – тренд")
+    ax.set_xlabel("Время")
+    ax.set_ylabel(ylabel)
+    ax.legend()
+    ax.grid(True)
+    indices = np.linspace(0, len(x) - 1, num=12, dtype=int) if len(x) > 12 else x
+    ax.set_xticks(indices, [datetime.fromtimestamp(times[i]).strftime(date_format) for i in indices], rotation=45)
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    return buf.getvalue()
 
-# Основной обработчик текстовых сообщений
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.strip().upper()
-    if text in fiat_info or text in crypto_info:
-        if text in crypto_info:
-            await convert_crypto_command(update, context, text,
-                                         load_user_settings(update.effective_user.id)["default_currency"])
-        else:
-            await convert_fiat_command(update, context, text)
-    elif text == '🔄 КОНВЕРТЕР':
-        await tracked_reply(update, "Введите код валюты для конвертации.\nПример: BTC или USD")
-    elif text == '💰 ПОПУЛЯРНЫЕ ВАЛЮТЫ':
-        await popular_currencies_initial(update, context)
-    elif text == '💵 ПОПУЛЯРНЫЕ КРИПТОВАЛЮТЫ':
-        await popular_cryptocurrencies_initial(update, context)
-    elif text == '❓ ПОМОЩЬ':
-        await help_command(update, context)
-    elif text == '⚙️ НАСТРОЙКИ':
-        await settings_command(update, context)
-    elif text == '📊 ПОДПИСКИ':
-        await show_subscriptions(update, context)
-    elif text == '🗑 ОЧИСТИТЬ ЧАТ':
-        await clear_history(update, context)
-    elif text == '/LISTCRYPTO':
-        await list_available_crypto(update, context)
-    elif text == '/LISTFIAT':
-        await list_available_fiat(update, context)
-    elif text.startswith('/COMPARE'):
-        await compare_crypto_prices(update, context)
-    else:
-        await tracked_reply(update, "Неизвестная команда. Введите /help", parse_mode="HTML")
 
+def get_chart_executor() -> ProcessPoolExecutor:
+    global _chart_executor
+    if _chart_executor is None:
+        _chart_executor = ProcessPoolExecutor(max_workers=CHART_WORKERS,
+                                              mp_context=multiprocessing.get_context("spawn"))
+    return _chart_executor
 
-# Команда /start
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await tracked_reply(update,
-                        "👋 Добро пожаловать!\n\nИспользуйте кнопки ниже или введите /help для списка команд",
-                        reply_markup=ReplyKeyboardMarkup(KEYBOARD, resize_keyboard=True))
 
+def close_chart_executor():
+    global _chart_executor
+    if _chart_executor is not None:
+        _chart_executor.shutdown(wait=False, cancel_futures=True)
+        _chart_executor = None
 
-# Команда /help – красивый вывод
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    help_text = """
-📖 <b>Доступные команды:</b>
-• /start – Главное меню
-• /convert <code>Код</code> [<code>Целевая</code>] – Конвертация валют
-• /subscribe <code>Пара</code> – Подписка на уведомления
-• /subscriptions – Список подписок
-• /trend <code>Код</code> [<code>Период</code>] – График тренда 
-      (Период задается числом и единицей: m – минуты, h – часы, d – дни, mo – месяцы, y – годы)
-• /check <code>Код</code> – Информация о валюте
-• /listcrypto – Список всех криптовалют на бирже
-• /listfiat – Список всех фиатных валют
-• /compare <code>Код</code> – Сравнение цен криптовалюты на разных платформах
-• /settings – Настройки (уведомления, валюта по умолчанию, источник данных)
-• /clear – Очистка истории
 
-<b>Примеры:</b>
-• /convert BTC
-• /convert BTC RUB
-• /subscribe BTCUSDT
-• /trend ETH 48h
-• /trend EUR 1y
-• /check USD
-• /listcrypto
-• /listfiat
-• /compare BTC
-    """
-    await tracked_reply(update, help_text, parse_mode="HTML")
+# Место в очереди графиков занимается сразу после проверки лимита, до загрузки данных
+# и без await между проверкой и увеличением счётчика — иначе вся пачка запросов
+# проходит проверку раньше, чем кто-то из них займёт место
+async def reserve_chart_slot(processing_msg) -> bool:
+    global _chart_pending
+    if _chart_pending >= CHART_QUEUE_LIMIT:
+        await processing_msg.edit_text("⚠️ Сейчас строится слишком много графиков, попробуйте через минуту",
+                                       parse_mode="HTML")
+        return False
+    _chart_pending += 1
+    return True
 
 
-# Команда /settings – настройка уведомлений, валюты и источника данных
-async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    settings = load_user_settings(update.effective_user.id)
-    status = "ВКЛ" if settings["notifications"] else "ВЫКЛ"
-    text = (f"⚙️ <b>Настройки</b>:\n"
-            f"Уведомления: {status}\n"
-            f"Валюта по умолчанию: {settings['default_currency']}\n"
-            f"Источник данных: {settings.get('data_source', 'BINANCE')}")
-    inline_kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("Вкл/Выкл уведомлений", callback_data="toggle_notifications")],
-        [InlineKeyboardButton("Изменить валюту", callback_data="change_default_currency")],
-        [InlineKeyboardButton("Изменить источник данных", callback_data="change_data_source")]
-    ])
-    await tracked_reply(update, text, reply_markup=inline_kb, parse_mode="HTML")
+def release_chart_slot():
+    global _chart_pending
+    _chart_pending -= 1
 
 
-# Команда /subscribe
-async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def render_chart_async(*args) -> bytes:
+    started = time.perf_counter()
     try:
-        pair = context.args[0].upper()
-        db_execute('INSERT OR IGNORE INTO subscriptions (user_id, pair) VALUES (?, ?)',
-                   (update.effective_user.id, pair))
-        await tracked_reply(update, f"✅ Подписка на {pair} добавлена", parse_mode="HTML")
-    except:
-        await tracked_reply(update, "❌ Используйте: /subscribe <Пара>")
+        return await asyncio.get_running_loop().run_in_executor(get_chart_executor(), render_trend_chart, *args)
+    finally:
+        metric_observe("chart_render_duration_seconds", time.perf_counter() - started)
 
 
-# Команда /subscriptions
-async def show_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    subs = db_fetchall('SELECT pair FROM subscriptions WHERE user_id = ?', (update.effective_user.id,))
-    text = "📋 Ваши подписки:\n" + "\n".join([f"• {s[0]}" for s in subs]) if subs else "Нет подписок"
-    await tracked_reply(update, text)
+# Кэш готовых графиков {(code, interval, limit, source, currency): {...}}.
+# Запись живёт до закрытия текущей свечи (но не дольше CHART_CACHE_MAX_TTL),
+# общий объём PNG ограничен CHART_CACHE_MAX_BYTES с LRU-вытеснением
+CHART_CACHE_MAX_BYTES = 32 * 1024 * 1024
+CHART_CACHE_MAX_TTL = 600
+_chart_cache = OrderedDict()
+_chart_cache_bytes = 0
 
 
-# Команда /clear
-async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    if chat_id in bot_messages:
-        for msg_id in bot_messages[chat_id]:
-            try:
-                await context.bot.delete_message(chat_id, msg_id)
-            except:
-                pass
-        bot_messages[chat_id] = []
-    await tracked_reply(update, "🗑 История очищена")
-
-
-# Команда /listcrypto – вывод всех доступных криптовалют с названиями
-async def list_available_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def store_cached_chart(key, interval: str, png: bytes, caption: str, file_id=None):
+    global _chart_cache_bytes
+    now = time.time()
+    step = INTERVAL_SECONDS.get(interval, 86400)
+    expires = min((now // step + 1) * step, now + CHART_CACHE_MAX_TTL)
+    old = _chart_cache.pop(key, None)
+    if old is not None:
+        _chart_cache_bytes -= len(old["png"])
+    _chart_cache[key] = {"png": png, "caption": caption, "file_id": file_id, "expires": expires}
+    _chart_cache_bytes += len(png)
+    while _chart_cache_bytes > CHART_CACHE_MAX_BYTES and _chart_cache:
+        _, evicted = _chart_cache.popitem(last=False)
+        _chart_cache_bytes -= len(evicted["png"])
+
+
+def get_cached_chart(key):
+    global _chart_cache_bytes
+    entry = _chart_cache.get(key)
+    if entry is not None and time.time() >= entry["expires"]:
+        del _chart_cache[key]
+        _chart_cache_bytes -= len(entry["png"])
+        entry = None
+    metric_inc("cache_requests_total", cache="chart", result="miss" if entry is None else "hit")
+    if entry is None:
+        return None
+    _chart_cache.move_to_end(key)
+    return entry
+
+
+# Отправка графика: заменяем сообщение «Обработка...» или отвечаем новым фото.
+# Возвращает file_id загруженного изображения для повторной отправки без загрузки
+async def send_trend_chart(update: Update, processing_msg, photo, caption: str):
     try:
-        resp = session.get("https://api.binance.com/api/v3/exchangeInfo", timeout=5)
-        data = resp.json()
-        symbols = data.get("symbols", [])
-        crypto_set = set()
-        for sym in symbols:
-            if sym.get("quoteAsset") == "USDT":
-                crypto_set.add(sym.get("baseAsset"))
-        crypto_list = sorted(list(crypto_set))
-        text = "💹 <b>Доступные криптовалюты (пары с USDT):</b>\n\n"
-        for c in crypto_list:
-            name = crypto_info.get(c, "Название неизвестно")
-            text += f"• {c} — {name}\n"
-        await tracked_reply(update, text, parse_mode="HTML")
+        msg = await processing_msg.edit_media(media=InputMediaPhoto(media=photo, caption=caption, parse_mode="HTML"))
     except Exception as e:
-        await tracked_reply(update, f"❌ Ошибка: {str(e)}", parse_mode="HTML")
+        msg = None
+        target = get_reply_target(update)
+        if target:
+            msg = await target.reply_photo(photo=photo, caption=caption, parse_mode="HTML")
+    return msg.photo[-1].file_id if getattr(msg, "photo", None) else None
 
 
-# Команда /listfiat – вывод всех доступных фиатных валют
-async def list_available_fiat(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = "💹 <b>Доступные фиатные валюты:</b>\n\n"
-    for code, name in sorted(fiat_info.items()):
-        text += f"• {code} — {name}\n"
-    await tracked_reply(update, text, parse_mode="HTML")
+# В кэше подпись хранится без заголовка: один ключ покрывает разные записи периода
+# (30d и 1mo), поэтому заголовок с периодом из запроса добавляется при отправке
+async def send_cached_chart(update: Update, processing_msg, key, title: str) -> bool:
+    entry = get_cached_chart(key)
+    if entry is None:
+        return False
+    file_id = await send_trend_chart(update, processing_msg, entry["file_id"] or entry["png"],
+                                     f"{title}\n{entry['caption']}")
+    if file_id:
+        entry["file_id"] = file_id
+    return True
 
 
-# Команда /compare – вывод цен криптовалюты на разных платформах и разница между ценами
-async def compare_crypto_prices(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Команда /check
+async def check_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        crypto = context.args[0].upper()
-    except:
-        return await tracked_reply(update, "Использование: /compare <Код> (например, /compare BTC)", parse_mode="HTML")
-    results = {}
-    sources = ["BINANCE", "GATEIO", "BYBIT"]
-    for source in sources:
-        try:
-            price = get_crypto_price_api(crypto, source)
-            results[source] = price
-        except Exception as e:
-            results[source] = None
-    text = f"📊 <b>Сравнение цен для {crypto}:</b>\n\n"
-    valid_prices = {}
-    for source, price in results.items():
-        if price is not None:
-            valid_prices[source] = price
-            text += f"• {source}: {price:,.2f} USD\n"
+        code = context.args[0].upper()
+        if code in fiat_info:
+            info = f"💵 {code}: {fiat_info[code]}"
+        elif code in crypto_info:
+            info = f"🪙 {code}: {crypto_info[code]}"
         else:
-            text += f"• {source}: Нет данных\n"
-    if valid_prices:
-        max_price = max(valid_prices.values())
-        min_price = min(valid_prices.values())
-        diff = max_price - min_price
-        pct = (diff / min_price * 100) if min_price != 0 else 0
-        text += f"\nРазница: {diff:,.2f} USD ({pct:+.2f}%)"
-    else:
-        text += "\nНет данных для сравнения."
-    await tracked_reply(update, text, parse_mode="HTML")
+            info = f"❓ Нет данных для кода {code}"
+    except:
+        info = "Использование: /check <Код> (например, /check USD)"
+    await tracked_reply(update, info, parse_mode="HTML")
 
 
 # Команда /trend – поддержка периода с единицами: m, h, d, mo, y
@@ -829,139 +1912,130 @@ async def trend_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             period_value, time_unit = 30, "days"
         else:
             return await tracked_reply(update, f"❓ Нет данных для кода {code}", parse_mode="HTML")
+    if not 0 < period_value * TREND_UNIT_DAYS[time_unit] <= TREND_MAX_PERIOD_DAYS:
+        return await tracked_reply(update, f"❌ Период должен быть от 1 минуты до {TREND_MAX_PERIOD_DAYS // 365} лет",
+                                   parse_mode="HTML")
     processing_msg = await tracked_reply(update,
                                          f"⏳ Обработка запроса для {code} за последние {period_value} {time_unit}...",
                                          parse_mode="HTML")
-    if code in crypto_info:
-        settings = load_user_settings(update.effective_user.id)
-        source = settings.get("data_source", "BINANCE")
-        if source == "BINANCE":
-            if time_unit in {"minutes", "hours"} and ((time_unit == "minutes" and period_value < 60 * 48) or (
-                    time_unit == "hours" and period_value < 48)):
-                interval = "1m" if time_unit == "minutes" else "1h"
-                limit = period_value
-            else:
-                interval = "1d"
-                if time_unit == "days":
+    reserved = False
+    try:
+        if code in crypto_info:
+            settings = await load_user_settings(update.effective_user.id)
+            source = settings.get("data_source", "BINANCE")
+            title = f"📈 {code} за последние {period_value} {time_unit}"
+            if source == "BINANCE":
+                if time_unit in {"minutes", "hours"} and ((time_unit == "minutes" and period_value < 60 * 48) or (
+                        time_unit == "hours" and period_value < 48)):
+                    interval = "1m" if time_unit == "minutes" else "1h"
                     limit = period_value
-                elif time_unit == "months":
-                    limit = period_value * 30
-                elif time_unit == "years":
-                    limit = period_value * 365
                 else:
-                    limit = period_value
-            url = f"https://api.binance.com/api/v3/klines?symbol={code}USDT&interval={interval}&limit={limit}"
-            data = session.get(url, timeout=5).json()
-            if not data or not isinstance(data, list):
-                return await processing_msg.edit_text("❌ Нет данных для графика", parse_mode="HTML")
-            date_format = '%H:%M' if interval in {"1m", "1h"} else '%d-%m'
-            dates = [datetime.fromtimestamp(entry[0] / 1000).strftime(date_format) for entry in data]
-            prices = [float(entry[4]) for entry in data]
-        elif source in {"GATEIO", "BYBIT"}:
-            interval = "1d"
-            if time_unit in {"days", "months", "years"}:
-                if time_unit == "days":
-                    limit = period_value
-                elif time_unit == "months":
-                    limit = period_value * 30
-                elif time_unit == "years":
-                    limit = period_value * 365
+                    interval = "1d"
+                    if time_unit == "days":
+                        limit = period_value
+                    elif time_unit == "months":
+                        limit = period_value * 30
+                    elif time_unit == "years":
+                        limit = period_value * 365
+                    elif time_unit == "hours":
+                        limit = math.ceil(period_value / 24)
+                    elif time_unit == "minutes":
+                        limit = math.ceil(period_value / (24 * 60))
+                    else:
+                        limit = period_value
+                interval, limit = coarsen_kline_interval(interval, limit)
+                cache_key = (code, interval, limit, source, "USDT")
+                if await send_cached_chart(update, processing_msg, cache_key, title):
+                    return
+                if not await reserve_chart_slot(processing_msg):
+                    return
+                reserved = True
+                try:
+                    data = await get_klines(f"{code}USDT", interval, limit)
+                except Exception as e:  # например, пара снята с торгов: Binance отвечает {"code": -1121, ...}
+                    print(f"Не удалось получить свечи {code}USDT: {e}")
+                    data = []
+                if not len(data):
+                    return await processing_msg.edit_text("❌ Нет данных для графика", parse_mode="HTML")
+                date_format = KLINE_DATE_FORMATS[interval]
+                times = data["open_time"] // 1000
+                prices = data["close"]
+            elif source in {"GATEIO", "BYBIT"}:
+                interval = "1d"
+                if time_unit in {"days", "months", "years"}:
+                    if time_unit == "days":
+                        limit = period_value
+                    elif time_unit == "months":
+                        limit = period_value * 30
+                    elif time_unit == "years":
+                        limit = period_value * 365
+                    else:
+                        limit = period_value
                 else:
-                    limit = period_value
+                    limit = 24
+                interval, limit = coarsen_kline_interval(interval, limit)
+                cache_key = (code, interval, limit, source, "USDT")
+                if await send_cached_chart(update, processing_msg, cache_key, title):
+                    return
+                if not await reserve_chart_slot(processing_msg):
+                    return
+                reserved = True
+                try:
+                    data = await get_klines(f"{code}USDT", interval, limit)
+                except Exception as e:  # например, пара снята с торгов: Binance отвечает {"code": -1121, ...}
+                    print(f"Не удалось получить свечи {code}USDT: {e}")
+                    data = []
+                if not len(data):
+                    return await processing_msg.edit_text("❌ Нет данных для графика", parse_mode="HTML")
+                date_format = KLINE_DATE_FORMATS[interval]
+                times = data["open_time"] // 1000
+                prices = data["close"]
+            pct_change = ((prices[-1] - prices[0]) / prices[0]) * 100
+            caption = f"Изменение: {pct_change:+.2f}%\nИсточник: {source}"
+        elif code in fiat_info:
+            if time_unit in {"minutes", "hours"}:
+                days = 1
+            elif time_unit == "days":
+                days = period_value
+            elif time_unit == "months":
+                days = period_value * 30
+            elif time_unit == "years":
+                days = period_value * 365
             else:
-                limit = 24
-            url = f"https://api.binance.com/api/v3/klines?symbol={code}USDT&interval={interval}&limit={limit}"
-            data = session.get(url, timeout=5).json()
-            dates = [datetime.fromtimestamp(entry[0] / 1000).strftime('%d-%m') for entry in data]
-            prices = [float(entry[4]) for entry in data]
-        pct_change = ((prices[-1] - prices[0]) / prices[0]) * 100
-        caption = f"📈 {code} за последние {period_value} {time_unit}\nИзменение: {pct_change:+.2f}%\nИсточник: {source}"
-    elif code in fiat_info:
-        if time_unit in {"minutes", "hours"}:
-            days = 1
-        elif time_unit == "days":
-            days = period_value
-        elif time_unit == "months":
-            days = period_value * 30
-        elif time_unit == "years":
-            days = period_value * 365
+                days = period_value
+            start_str = (datetime.today() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+            default = (await load_user_settings(update.effective_user.id))['default_currency']
+            interval = "1d"
+            title = f"📈 {code} → {default} за {days} дн."
+            cache_key = (code, interval, days, "CBR", default)
+            if await send_cached_chart(update, processing_msg, cache_key, title):
+                return
+            if not await reserve_chart_slot(processing_msg):
+                return
+            reserved = True
+            dates, prices = await get_fiat_cross_series(code, default, start_str)
+            if not len(prices):
+                # История по этим валютам ещё не загружена — догружаем по требованию
+                await sync_fiat_history(codes=[code, default])
+                dates, prices = await get_fiat_cross_series(code, default, start_str)
+            if not len(prices):
+                return await processing_msg.edit_text("❌ Нет данных для графика", parse_mode="HTML")
+            date_format = '%d-%m'
+            times = np.array([datetime.strptime(d, '%Y-%m-%d').timestamp() for d in dates])
+            pct_change = ((prices[-1] - prices[0]) / prices[0]) * 100
+            caption = f"Изменение: {pct_change:+.2f}%\nИсточник: ЦБ РФ"
         else:
-            days = period_value
-        end_date = datetime.today()
-        start_date = end_date - timedelta(days=days - 1)
-        start_str = start_date.strftime('%Y-%m-%d')
-        end_str = end_date.strftime('%Y-%m-%d')
-        default = load_user_settings(update.effective_user.id)['default_currency']
-        url = f"https://api.exchangerate.host/timeseries?start_date={start_str}&end_date={end_str}&base={code}&symbols={default}"
-        data_json = session.get(url, timeout=5).json()
-        rates = data_json.get("rates", {})
-        if not rates:
-            return await processing_msg.edit_text("❌ Нет данных для графика", parse_mode="HTML")
-        sorted_dates = sorted(rates.keys())
-        dates = [datetime.strptime(d, '%Y-%m-%d').strftime('%d-%m') for d in sorted_dates]
-        prices = [rates[d][default] for d in sorted_dates]
-        pct_change = ((prices[-1] - prices[0]) / prices[0]) * 100
-        caption = f"📈 {code} → {default} за {days} дн.\nИзменение: {pct_change:+.2f}%\nИсточник: exchangerate.host"
-    else:
-        return await processing_msg.edit_text(f"❓ Нет данных для кода {code}", parse_mode="HTML")
-    x = np.arange(len(prices))
-    slope, intercept = np.polyfit(x, prices, 1)
-    trend_line = slope * x + intercept
-    plt.figure(figsize=(10, 6))
-    plt.plot(x, prices, marker='o', linestyle='-', color='blue', label='Цена')
-    plt.plot(x, trend_line, color='red', linestyle='--', linewidth=2, label='Тренд')
-    plt.plot(x[-1], trend_line[-1], 'ro', markersize=5)
-    plt.title(f"{code} – тренд")
-    plt.xlabel("Время")
-    ylabel = "Цена (USDT)" if code in crypto_info else f"Цена ({default})"
-    plt.ylabel(ylabel)
-    plt.legend()
-    plt.grid(True)
-    if len(x) > 12:
-        indices = np.linspace(0, len(x) - 1, num=12, dtype=int)
-        plt.xticks(indices, [dates[i] for i in indices], rotation=45)
-    else:
-        plt.xticks(x, dates, rotation=45)
-    plt.tight_layout()
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
-    plt.close()
-    try:
-        await processing_msg.edit_media(media=InputMediaPhoto(media=buf, caption=caption, parse_mode="HTML"))
-    except Exception as e:
-        target = get_reply_target(update)
-        if target:
-            await target.reply_photo(photo=buf, caption=caption, parse_mode="HTML")
-
-
-# Команды подписки и отображения подписок
-async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        pair = context.args[0].upper()
-        db_execute('INSERT OR IGNORE INTO subscriptions (user_id, pair) VALUES (?, ?)',
-                   (update.effective_user.id, pair))
-        await tracked_reply(update, f"✅ Подписка на {pair} добавлена", parse_mode="HTML")
-    except:
-        await tracked_reply(update, "❌ Используйте: /subscribe <Пара>")
-
-
-async def show_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    subs = db_fetchall('SELECT pair FROM subscriptions WHERE user_id = ?', (update.effective_user.id,))
-    text = "📋 Ваши подписки:\n" + "\n".join([f"• {s[0]}" for s in subs]) if subs else "Нет подписок"
-    await tracked_reply(update, text)
-
-
-async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    if chat_id in bot_messages:
-        for msg_id in bot_messages[chat_id]:
-            try:
-                await context.bot.delete_message(chat_id, msg_id)
-            except:
-                pass
-        bot_messages[chat_id] = []
-    await tracked_reply(update, "🗑 История очищена")
+            return await processing_msg.edit_text(f"❓ Нет данных для кода {code}", parse_mode="HTML")
+        ylabel = "Цена (USDT)" if code in crypto_info else f"Цена ({default})"
+        if _chart_pending > CHART_WORKERS:
+            await processing_msg.edit_text(f"⏳ График в очереди, перед вами: {_chart_pending - CHART_WORKERS}",
+                                           parse_mode="HTML")
+        png = await render_chart_async(code, times, prices, ylabel, date_format)
+        file_id = await send_trend_chart(update, processing_msg, png, f"{title}\n{caption}")
+        store_cached_chart(cache_key, interval, png, caption, file_id)
+    finally:
+        if reserved:
+            release_chart_slot()
 
 
 # Обработка inline-кнопок
@@ -972,13 +2046,13 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = query.data
     if data.startswith("crypto_"):
         await convert_crypto_command(update, context, data.split("_")[1],
-                                     load_user_settings(user_id)["default_currency"])
+                                     (await load_user_settings(user_id))["default_currency"])
     elif data.startswith("fiat_"):
         await convert_fiat_command(update, context, data.split("_")[1])
     elif data == "toggle_notifications":
-        settings = load_user_settings(user_id)
+        settings = await load_user_settings(user_id)
         settings["notifications"] = not settings["notifications"]
-        save_user_settings(user_id, settings)
+        await save_user_settings(user_id, settings)
         status = "ВКЛ" if settings["notifications"] else "ВЫКЛ"
         await query.edit_message_text(f"⚙️ Уведомления: {status}")
     elif data == "change_default_currency":
@@ -988,9 +2062,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("Выберите валюту по умолчанию:", reply_markup=inline_kb)
     elif data.startswith("set_default_"):
         new_currency = data.split("_")[2]
-        settings = load_user_settings(user_id)
+        settings = await load_user_settings(user_id)
         settings["default_currency"] = new_currency
-        save_user_settings(user_id, settings)
+        await save_user_settings(user_id, settings)
         await query.edit_message_text(f"✅ Валюта по умолчанию: {new_currency}")
     elif data == "change_data_source":
         inline_kb = InlineKeyboardMarkup([[
@@ -1001,15 +2075,22 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("Выберите источник данных для криптовалют:", reply_markup=inline_kb)
     elif data.startswith("set_source_"):
         new_source = data.split("_")[2]
-        settings = load_user_settings(user_id)
+        settings = await load_user_settings(user_id)
         settings["data_source"] = new_source
-        save_user_settings(user_id, settings)
+        await save_user_settings(user_id, settings)
         await query.edit_message_text(f"✅ Источник данных: {new_source}")
     elif data in ["show_rates_fiat", "show_rates_crypto"]:
         if "fiat" in data:
             await handle_show_rates_fiat(update, context)
         else:
             await handle_show_rates_crypto(update, context)
+    elif data.startswith("listcrypto_"):
+        _, source, page = data.split("_")
+        try:
+            text, inline_kb = render_crypto_page(source, await get_symbol_catalog(source), int(page))
+            await query.edit_message_text(text, parse_mode="HTML", reply_markup=inline_kb)
+        except Exception as e:
+            await query.edit_message_text(f"❌ Ошибка: {str(e)}", parse_mode="HTML")
     else:
         await query.edit_message_text("Неизвестная команда.", parse_mode="HTML")
 
@@ -1020,7 +2101,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if text in fiat_info or text in crypto_info:
         if text in crypto_info:
             await convert_crypto_command(update, context, text,
-                                         load_user_settings(update.effective_user.id)["default_currency"])
+                                         (await load_user_settings(update.effective_user.id))["default_currency"])
         else:
             await convert_fiat_command(update, context, text)
     elif text == '🔄 КОНВЕРТЕР':
@@ -1060,7 +2141,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📖 <b>Доступные команды:</b>
 • /start – Главное меню
 • /convert <code>Код</code> [<code>Целевая</code>] – Конвертация валют
-• /subscribe <code>Пара</code> – Подписка на уведомления
+• /subscribe <code>Пара</code> [<code>Порог</code>] – Подписка на уведомления о пересечении порога
 • /subscriptions – Список подписок
 • /trend <code>Код</code> [<code>Период</code>] – График тренда 
       (Период задается числом и единицей: m – минуты, h – часы, d – дни, mo – месяцы, y – годы)
@@ -1077,6 +2158,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • /convert BTC
 • /convert BTC RUB
 • /subscribe BTCUSDT
+• /subscribe BTCUSDT 70000
 • /trend ETH 48h
 • /trend EUR 1y
 • /check USD
@@ -1089,7 +2171,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Команда /settings – настройка уведомлений, валюты и источника данных
 async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    settings = load_user_settings(update.effective_user.id)
+    settings = await load_user_settings(update.effective_user.id)
     status = "ВКЛ" if settings["notifications"] else "ВЫКЛ"
     text = (f"⚙️ <b>Настройки</b>:\n"
             f"Уведомления: {status}\n"
@@ -1107,31 +2189,147 @@ async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         pair = context.args[0].upper()
-        db_execute('INSERT OR IGNORE INTO subscriptions (user_id, pair) VALUES (?, ?)',
-                   (update.effective_user.id, pair))
-        await tracked_reply(update, f"✅ Подписка на {pair} добавлена", parse_mode="HTML")
+        threshold = float(context.args[1].replace(",", ".")) if len(context.args) > 1 else None
     except:
-        await tracked_reply(update, "❌ Используйте: /subscribe <Пара>")
+        return await tracked_reply(update, "❌ Используйте: /subscribe <Пара> [Порог]")
+    if threshold is None:
+        await db_execute('INSERT OR IGNORE INTO subscriptions (user_id, pair) VALUES (?, ?)',
+                         (update.effective_user.id, pair))
+        await tracked_reply(update, f"✅ Подписка на {pair} добавлена", parse_mode="HTML")
+    else:
+        await db_execute('''
+            INSERT INTO subscriptions (user_id, pair, threshold) VALUES (?, ?, ?)
+            ON CONFLICT(user_id, pair) DO UPDATE SET threshold = excluded.threshold
+        ''', (update.effective_user.id, pair, threshold))
+        await tracked_reply(update, f"✅ Подписка на {pair} добавлена, порог: {threshold:,.8g}", parse_mode="HTML")
 
 
 # Команда /subscriptions
 async def show_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    subs = db_fetchall('SELECT pair FROM subscriptions WHERE user_id = ?', (update.effective_user.id,))
-    text = "📋 Ваши подписки:\n" + "\n".join([f"• {s[0]}" for s in subs]) if subs else "Нет подписок"
+    subs = await db_fetchall('SELECT pair, threshold FROM subscriptions WHERE user_id = ?', (update.effective_user.id,))
+    lines = [f"• {pair}" if threshold is None else f"• {pair} (порог: {threshold:,.8g})" for pair, threshold in subs]
+    text = "📋 Ваши подписки:\n" + "\n".join(lines) if subs else "Нет подписок"
     await tracked_reply(update, text)
 
 
-# Команда /clear
+# Фоновая проверка порогов подписок.
+# Подписки группируются по паре: каждая пара запрашивается один раз за проход,
+# пороги всех подписчиков сравниваются одной векторной операцией
+_alert_last_prices = {}  # {pair: цена на предыдущем проходе}
+
+
+def pair_base_asset(pair: str) -> str:
+    return pair[:-4] if pair.endswith("USDT") and len(pair) > 4 else pair
+
+
+async def send_alert_batches(bot, messages):
+    for i in range(0, len(messages), ALERT_BATCH_SIZE):
+        if i:
+            await asyncio.sleep(ALERT_BATCH_INTERVAL)
+        batch = messages[i:i + ALERT_BATCH_SIZE]
+        results = await asyncio.gather(*(bot.send_message(chat_id, text) for chat_id, text in batch),
+                                       return_exceptions=True)
+        for (chat_id, _), result in zip(batch, results):
+            if isinstance(result, Exception):
+                print(f"Не удалось отправить уведомление {chat_id}: {result}")
+
+
+# Подписки хранятся в локальной БД каждого экземпляра, поэтому проверка идёт на каждом
+# экземпляре по его подписчикам и с его собственными прошлыми ценами
+async def check_price_alerts(context: ContextTypes.DEFAULT_TYPE):
+    rows = await db_fetchall('''
+        SELECT s.user_id, s.pair, s.threshold
+        FROM subscriptions s LEFT JOIN user_settings u ON u.user_id = s.user_id
+        WHERE s.threshold IS NOT NULL AND COALESCE(u.notifications, 1) = 1
+    ''')
+    if not rows:
+        return
+    user_ids = np.array([r[0] for r in rows], dtype=np.int64)
+    thresholds = np.array([r[2] for r in rows], dtype=np.float64)
+    pairs, pair_idx = np.unique([r[1] for r in rows], return_inverse=True)
+    results = await asyncio.gather(*(get_crypto_price_api(pair_base_asset(pair), ALERT_PRICE_SOURCE)
+                                     for pair in pairs), return_exceptions=True)
+    current = np.array([np.nan if isinstance(r, Exception) else r for r in results], dtype=np.float64)
+    previous = np.array([_alert_last_prices.get(pair, np.nan) for pair in pairs], dtype=np.float64)
+    for pair, price in zip(pairs, current):
+        if not np.isnan(price):
+            _alert_last_prices[pair] = price
+    cur = current[pair_idx]
+    prev = previous[pair_idx]
+    # Порог пересечён, если с прошлого прохода цена перешла на другую сторону от него
+    crossed = ~np.isnan(cur) & ~np.isnan(prev) & (np.sign(prev - thresholds) != np.sign(cur - thresholds))
+    messages = []
+    for i in np.flatnonzero(crossed):
+        direction = "📈 выше" if cur[i] >= thresholds[i] else "📉 ниже"
+        messages.append((int(user_ids[i]),
+                         f"🔔 {pairs[pair_idx[i]]}: цена {cur[i]:,.8g} {direction} порога {thresholds[i]:,.8g}"))
+    if messages:
+        await send_alert_batches(context.bot, messages)
+
+
+# Команда /clear. Сообщения удаляются пачками через deleteMessages (до 100 id за вызов,
+# python-telegram-bot >= 20.8), пачки идут параллельно; при RetryAfter все запросы
+# чата ждут столько, сколько просит Telegram. Если пачку целиком удалить не удалось,
+# её сообщения удаляются по одному
+CLEAR_CHUNK_SIZE = 100
+CLEAR_CONCURRENCY = 4
+CLEAR_MAX_RETRIES = 3
+
+
+async def call_with_flood_control(call, limiter: asyncio.Semaphore, pause: dict):
+    for _ in range(CLEAR_MAX_RETRIES):
+        async with limiter:
+            delay = pause["until"] - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                return await call()
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                pause["until"] = max(pause["until"], time.monotonic() + retry_after)
+    return None  # Telegram так и не снял ограничение
+
+
+async def delete_one_message(bot, chat_id: int, message_id: int, limiter: asyncio.Semaphore, pause: dict) -> int:
+    try:
+        return int(bool(await call_with_flood_control(lambda: bot.delete_message(chat_id, message_id),
+                                                      limiter, pause)))
+    except TelegramError:  # сообщение уже удалено или старше 48 часов
+        return 0
+
+
+# Возвращает, сколько сообщений Telegram принял к удалению: deleteMessages отвечает True,
+# даже если часть id пропущена (уже удалены или старше 48 часов)
+async def delete_message_chunk(bot, chat_id: int, chunk: list, limiter: asyncio.Semaphore, pause: dict) -> int:
+    if len(chunk) > 1:
+        try:
+            result = await call_with_flood_control(lambda: bot.delete_messages(chat_id, chunk), limiter, pause)
+            return len(chunk) if result else 0
+        except TelegramError as e:
+            print(f"Не удалось удалить пачку сообщений в чате {chat_id}, удаляем по одному: {e}")
+    removed = await asyncio.gather(*(delete_one_message(bot, chat_id, message_id, limiter, pause)
+                                     for message_id in chunk))
+    return sum(removed)
+
+
+async def delete_tracked_messages(bot, chat_id: int, message_ids: list) -> int:
+    size = CLEAR_CHUNK_SIZE if hasattr(bot, "delete_messages") else 1
+    chunks = [message_ids[i:i + size] for i in range(0, len(message_ids), size)]
+    limiter = asyncio.Semaphore(CLEAR_CONCURRENCY)
+    pause = {"until": 0.0}
+    accepted = await asyncio.gather(*(delete_message_chunk(bot, chat_id, chunk, limiter, pause)
+                                      for chunk in chunks))
+    return sum(accepted)
+
+
 async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    if chat_id in bot_messages:
-        for msg_id in bot_messages[chat_id]:
-            try:
-                await context.bot.delete_message(chat_id, msg_id)
-            except:
-                pass
-        bot_messages[chat_id] = []
-    await tracked_reply(update, "🗑 История очищена")
+    message_ids = await get_tracked_messages(chat_id)
+    await forget_tracked_messages(chat_id)
+    accepted = await delete_tracked_messages(context.bot, chat_id, message_ids)
+    await tracked_reply(update, f"🗑 История очищена, отправлено на удаление сообщений: {accepted}")
 
 
 # Пост и установка команд для бота
@@ -1149,14 +2347,180 @@ async def post_init(application: Application):
         BotCommand("clear", "Очистка истории")
     ]
     await application.bot.set_my_commands(commands)
+    start_price_streams()
+    await start_metrics_server()
+
+
+# Освобождение ресурсов при остановке бота
+async def post_shutdown(application: Application):
+    await stop_metrics_server()
+    await stop_price_streams()
+    await close_http_client()
+    close_chart_executor()
+    await flush_tracked_messages()
+    await state_backend.close()
+    close_db()
+
+
+# Запись входящих апдейтов (RECORD_UPDATES_FILE) для последующего воспроизведения.
+# Файл пишется в отдельном потоке, а обработчик не блокирует обработку апдейта
+def _append_recorded_update(line: str):
+    with open(RECORD_UPDATES_FILE, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(_append_recorded_update, update.to_json())
+
+
+# В режиме воспроизведения (LOCAL_BOT_API_URL) после всех обработчиков апдейта бот
+# сообщает заглушке Bot API, что апдейт обработан — так меряется полная задержка
+async def report_update_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await context.bot.do_api_request("replayDone", api_kwargs={"update_id": update.update_id})
+
+
+# Заглушка Bot API для воспроизведения: отвечает на вызовы бота правдоподобными
+# результатами, ничего не отправляя в Telegram, и отмечает завершение апдейтов
+def fake_bot_api_result(method: str, params: dict, message_ids):
+    if method == "getMe":
+        return {"id": 1, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+    if method in {"sendMessage", "sendPhoto", "editMessageText", "editMessageMedia"}:
+        try:
+            chat_id = int(json.loads(params.get("chat_id", "0")))
+        except (TypeError, ValueError):
+            chat_id = 0
+        message = {"message_id": next(message_ids), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"}, "text": ""}
+        if method in {"sendPhoto", "editMessageMedia"}:
+            message["photo"] = [{"file_id": "replay", "file_unique_id": "replay", "width": 1, "height": 1}]
+        return message
+    return True
+
+
+async def run_fake_bot_api(on_done, webhook_ready: asyncio.Event):
+    message_ids = itertools.count(1)
+    connections = {}  # {writer: задача обработчика соединения}
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connections[writer] = asyncio.current_task()
+        try:
+            while True:  # httpx держит соединение открытым между запросами
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                method = request_line.decode("latin-1").split()[1].rsplit("/", 1)[-1]
+                params = {}
+                if headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+                    params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+                if method == "replayDone":
+                    on_done(int(json.loads(params["update_id"])))
+                elif method == "setWebhook":
+                    webhook_ready.set()
+                payload = json.dumps({"ok": True, "result": fake_bot_api_result(method, params, message_ids)}).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                             b"Content-Length: " + str(len(payload)).encode() + b"\r\n\r\n" + payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            connections.pop(writer, None)
+            writer.close()
+
+    parts = urlsplit(LOCAL_BOT_API_URL)
+    server = await asyncio.start_server(handle, parts.hostname, parts.port)
+    return server, connections
+
+
+# Замер задержки: python main.py replay updates.jsonl [параллельность]
+# Сначала запускается replay (поднимает заглушку Bot API), затем бот с WEBHOOK_ENABLED
+# и LOCAL_BOT_API_URL — его вызовы Bot API уходят в заглушку, а не в реальные чаты из записи.
+# Отправка начинается, когда бот зарегистрирует webhook. Меряются две задержки:
+# приём апдейта webhook-сервером и полная — до завершения всех обработчиков
+REPLAY_DONE_TIMEOUT = 30  # сколько ждать обработки всех апдейтов после отправки, сек
+
+
+async def replay_updates(path: str, concurrency: int = 10):
+    with open(path, encoding="utf-8") as f:
+        bodies = [line.strip() for line in f if line.strip()]
+    url = f"http://{WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}"
+    headers = {"Content-Type": "application/json"}
+    if WEBHOOK_SECRET_TOKEN:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = WEBHOOK_SECRET_TOKEN
+    semaphore = asyncio.Semaphore(concurrency)
+    sent_at, accept_latencies, done_latencies, errors = {}, [], [], []
+    all_done = asyncio.Event()
+
+    def on_done(update_id: int):
+        started = sent_at.pop(update_id, None)
+        if started is not None:
+            done_latencies.append(time.perf_counter() - started)
+        if not sent_at:
+            all_done.set()
+
+    async def post(client, body):
+        async with semaphore:
+            update_id = json.loads(body)["update_id"]
+            sent_at[update_id] = start = time.perf_counter()
+            try:
+                resp = await client.post(url, content=body, headers=headers)
+                resp.raise_for_status()
+                accept_latencies.append(time.perf_counter() - start)
+            except httpx.HTTPError as e:
+                sent_at.pop(update_id, None)
+                errors.append(e)
+
+    webhook_ready = asyncio.Event()
+    server, connections = await run_fake_bot_api(on_done, webhook_ready)
+    try:
+        print(f"Заглушка Bot API слушает {LOCAL_BOT_API_URL}, ожидание запуска бота...")
+        await webhook_ready.wait()
+        async with httpx.AsyncClient(timeout=10) as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(post(client, body) for body in bodies))
+            all_done.clear()
+            if sent_at:
+                try:
+                    await asyncio.wait_for(all_done.wait(), REPLAY_DONE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+            elapsed = time.perf_counter() - started
+    finally:
+        server.close()
+        handlers = list(connections.values())
+        for writer in list(connections):  # соединения бота держатся открытыми (keep-alive)
+            writer.close()
+        await asyncio.gather(*handlers, return_exceptions=True)
+        await server.wait_closed()
+    print(f"Отправлено {len(bodies)} апдейтов за {elapsed:.2f} сек, ошибок: {len(errors)}, "
+          f"не дождались обработки: {len(sent_at)}")
+    if errors:
+        print(f"Первая ошибка: {errors[0]!r}")
+    for title, latencies in (("приём webhook", accept_latencies), ("полная обработка", done_latencies)):
+        if latencies:
+            ms = np.array(latencies) * 1000
+            p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+            print(f"Задержка ({title}), мс: p50={p50:.1f} p90={p90:.1f} p99={p99:.1f} max={ms.max():.1f}")
+    if done_latencies:
+        print(f"Пропускная способность: {len(done_latencies) / elapsed:.1f} апдейтов/сек")
 
 
 # Основной запуск бота
 def main():
-    application = Application.builder() \
+    init_db()
+    init_state_backend()
+    load_cbr_cache()
+    builder = Application.builder() \
         .token(BOT_TOKEN) \
         .post_init(post_init) \
-        .build()
+        .post_shutdown(post_shutdown)
+    if LOCAL_BOT_API_URL:
+        builder = builder.base_url(LOCAL_BOT_API_URL)
+    application = builder.build()
 
     application.add_handler(CommandHandler('start', start))
     application.add_handler(CommandHandler('convert', convert_command))
@@ -1172,8 +2536,34 @@ def main():
 
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(CallbackQueryHandler(button_handler))
+    if RECORD_UPDATES_FILE:
+        application.add_handler(TypeHandler(Update, record_update, block=False), group=-1)
+    if LOCAL_BOT_API_URL:
+        application.add_handler(TypeHandler(Update, report_update_done), group=99)
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_handler(handler.callback)
+
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(refresh_cbr_data, interval=CBR_REFRESH_INTERVAL, first=0)
+        application.job_queue.run_repeating(refresh_ticker_snapshots, interval=TICKER_SNAPSHOT_INTERVAL, first=0)
+        application.job_queue.run_repeating(refresh_symbol_catalog, interval=SYMBOL_CATALOG_TTL, first=0)
+        application.job_queue.run_repeating(sync_fiat_history, interval=FIAT_HISTORY_SYNC_INTERVAL, first=5)
+        if STREAMING_ENABLED:
+            application.job_queue.run_repeating(prune_stream_symbols, interval=60, first=60)
+        application.job_queue.run_repeating(flush_tracked_messages, interval=MESSAGE_FLUSH_INTERVAL,
+                                            first=MESSAGE_FLUSH_INTERVAL)
+        application.job_queue.run_repeating(check_price_alerts, interval=ALERT_CHECK_INTERVAL,
+                                            first=ALERT_CHECK_INTERVAL)
+    else:
+        print("JobQueue недоступна (установите python-telegram-bot[job-queue]), фоновые задачи отключены")
 
-    application.run_polling()
+    if WEBHOOK_ENABLED:
+        application.run_webhook(listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+                                webhook_url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET_TOKEN or None,
+                                allowed_updates=Update.ALL_TYPES)
+    else:
+        application.run_polling()
 
 
 # Добавляем новые функции после существующих обработчиков
@@ -1207,10 +2597,10 @@ async def popular_cryptocurrencies_initial(update: Update, context: ContextTypes
 async def handle_show_rates_fiat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает курсы популярных фиатных валют"""
     try:
-        text = "📊 Текущие курсы фиатных валют:\n\n"
-        for code in ["USD", "EUR", "GBP", "JPY", "CNY"]:
-            rate = convert_fiat_value(1, code, "RUB")
-            text += f"• 1 {code} = {rate:.2f} RUB\n"
+        codes = ["USD", "EUR", "GBP", "JPY", "CNY"]
+        rates = await convert_fiat_values(1, codes, "RUB")
+        text = "📊 Текущие курсы фиатных валют:\n\n" + "".join(
+            f"• 1 {code} = {rate:.2f} RUB\n" for code, rate in zip(codes, rates)) + cbr_staleness_note()
         await update.callback_query.edit_message_text(text)
     except Exception as e:
         await update.callback_query.edit_message_text(f"❌ Ошибка: {str(e)}")
@@ -1220,12 +2610,12 @@ async def handle_show_rates_crypto(update: Update, context: ContextTypes.DEFAULT
     """Показывает курсы популярных криптовалют"""
     try:
         user_id = update.effective_user.id
-        settings = load_user_settings(user_id)
+        settings = await load_user_settings(user_id)
         text = "📊 Текущие курсы криптовалют:\n\n"
 
         for code in ["BTC", "ETH", "BNB", "DOGE", "XRP"]:
             try:
-                price = get_crypto_price_api(code, settings["data_source"])
+                price = await get_crypto_price_api(code, settings["data_source"])
                 text += f"• 1 {code} = {price:,.2f} USD\n"
             except:
                 text += f"• {code}: Нет данных\n"
@@ -1235,4 +2625,7 @@ async def handle_show_rates_crypto(update: Update, context: ContextTypes.DEFAULT
         await update.callback_query.edit_message_text(f"❌ Ошибка: {str(e)}")
 
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 2 and sys.argv[1] == 'replay':
+        asyncio.run(replay_updates(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 10))
+    else:
+        main()
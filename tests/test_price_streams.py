@@ -0,0 +1,71 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+import main
+
+
+def test_subscription_messages_per_exchange():
+    binance = main.stream_subscription_messages("BINANCE", ["ETH", "BTC"])
+    assert len(binance) == 1
+    assert binance[0]["method"] == "SUBSCRIBE"
+    assert binance[0]["params"] == ["btcusdt@miniTicker", "ethusdt@miniTicker"]
+
+    gateio = main.stream_subscription_messages("GATEIO", ["BTC"], subscribe=False)
+    assert gateio[0]["event"] == "unsubscribe"
+    assert gateio[0]["payload"] == ["BTC_USDT"]
+
+    bybit = main.stream_subscription_messages("BYBIT", [f"C{i}" for i in range(25)])
+    assert [len(m["args"]) for m in bybit] == [10, 10, 5]
+    assert main.stream_subscription_messages("BINANCE", []) == []
+
+
+def test_parse_stream_message_per_exchange():
+    assert main.parse_stream_message("BINANCE", {"e": "24hrMiniTicker", "s": "BTCUSDT", "c": "65000.5"}) == \
+        [("BTC", 65000.5)]
+    assert main.parse_stream_message("GATEIO", {"channel": "spot.tickers", "event": "update",
+                                                "result": {"currency_pair": "ETH_USDT", "last": "3100"}}) == \
+        [("ETH", 3100.0)]
+    assert main.parse_stream_message("BYBIT", {"topic": "tickers.SOLUSDT",
+                                               "data": {"symbol": "SOLUSDT", "lastPrice": "150.2"}}) == \
+        [("SOL", 150.2)]
+    # служебные ответы бирж (подтверждение подписки и т.п.) пропускаются
+    assert main.parse_stream_message("BINANCE", {"result": None, "id": 1}) == []
+    assert main.parse_stream_message("GATEIO", {"channel": "spot.tickers", "event": "subscribe"}) == []
+    assert main.parse_stream_message("BYBIT", {"op": "subscribe", "success": True}) == []
+
+
+def test_run_price_stream_against_local_server(monkeypatch):
+    websockets = pytest.importorskip("websockets")
+
+    async def scenario():
+        received = []
+
+        async def handler(ws):
+            received.append(json.loads(await ws.recv()))
+            await ws.send(json.dumps({"e": "24hrMiniTicker", "s": "BTCUSDT", "c": "64000"}))
+            await ws.wait_closed()
+
+        async with websockets.serve(handler, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            monkeypatch.setitem(main.STREAM_URLS, "BINANCE", f"ws://127.0.0.1:{port}")
+            monkeypatch.setitem(main._stream_symbols, "BINANCE", {"BTC": time.time()})
+            monkeypatch.setattr(main, "STREAMING_ENABLED", True)
+            task = asyncio.create_task(main.run_price_stream("BINANCE"))
+            try:
+                for _ in range(100):
+                    if main.get_stream_price("BTC", "BINANCE") is not None:
+                        break
+                    await asyncio.sleep(0.02)
+            finally:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        return received
+
+    main._stream_prices.clear()
+    received = asyncio.run(scenario())
+    assert received[0]["params"] == ["btcusdt@miniTicker"]
+    assert main.get_stream_price("BTC", "BINANCE") == 64000.0
+    main._stream_prices.clear()
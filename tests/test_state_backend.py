@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+import main
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+def run_with_backend(scenario):
+    async def wrapper():
+        backend = main.RedisStateBackend(fakeredis.FakeAsyncRedis())
+        try:
+            return await scenario(backend)
+        finally:
+            await backend.close()
+
+    return asyncio.run(wrapper())
+
+
+def test_get_set_nx_and_ttl():
+    async def scenario(backend):
+        assert await backend.get("missing") is None
+        assert await backend.set("cbr", {"timestamp": 1.0, "data": {"Valute": {}}})
+        assert await backend.get("cbr") == {"timestamp": 1.0, "data": {"Valute": {}}}
+        # nx не перезаписывает существующую запись
+        assert not await backend.set("cbr", {"timestamp": 2.0}, nx=True)
+        assert (await backend.get("cbr"))["timestamp"] == 1.0
+        assert await backend.set("settings:1", {"data_source": "BYBIT"}, nx=True)
+
+        await backend.set("price:BINANCE:BTC", [65000.0, 1.0], ttl=0.05)
+        assert await backend.get("price:BINANCE:BTC") == [65000.0, 1.0]
+        await asyncio.sleep(0.1)
+        assert await backend.get("price:BINANCE:BTC") is None
+
+    run_with_backend(scenario)
+
+
+def test_acquire_lock_is_exclusive_until_expiry():
+    async def scenario(backend):
+        assert await backend.acquire_lock("snapshot:BINANCE", 0.05)
+        assert not await backend.acquire_lock("snapshot:BINANCE", 0.05)
+        assert await backend.acquire_lock("snapshot:GATEIO", 0.05)
+        await asyncio.sleep(0.1)
+        assert await backend.acquire_lock("snapshot:BINANCE", 0.05)
+
+    run_with_backend(scenario)
+
+
+def test_messages_are_trimmed_per_chat(monkeypatch):
+    monkeypatch.setattr(main, "MESSAGE_TRACK_PER_CHAT", 3)
+
+    async def scenario(backend):
+        await backend.add_messages([(1, i) for i in range(1, 6)] + [(2, 100)])
+        await backend.add_messages([(1, 6)])
+        assert await backend.get_messages(1, 10) == [4, 5, 6]
+        assert await backend.client.llen(f"{backend.prefix}messages:1") == 3
+        assert await backend.get_messages(2, 3) == [100]
+        await backend.delete_messages(1)
+        assert await backend.get_messages(1, 3) == []
+        assert await backend.get_messages(2, 3) == [100]
+
+    run_with_backend(scenario)